@@ -0,0 +1,141 @@
+import os
+import json
+import bisect
+import shutil
+import tempfile
+
+def replace_atomically(path, write):
+    """Write a new version of path with write(outf), then rename it into place so readers never see a partial file.
+    """
+    tmp = tempfile.NamedTemporaryFile("wb", dir=os.path.dirname(os.path.abspath(path)), prefix=".tmp.", delete=False)
+    try:
+        with tmp as outf:
+            write(outf)
+        if os.path.exists(path):
+            shutil.copymode(path, tmp.name)
+        os.replace(tmp.name, path)
+    finally:
+        if os.path.exists(tmp.name):
+            os.remove(tmp.name)
+
+def add_representatives(lincsv, rows):
+    """Add (sample, lineage) rows to a lineages.csv, skipping any row the file already has. Returns the number of rows added.
+
+    The existing rows are read into a hashed set and the file is rewritten atomically with the new rows at the end.
+    """
+    existing = set()
+    if os.path.exists(lincsv):
+        with open(lincsv, "rb") as inf:
+            existing = set(line.rstrip(b"\r\n") for line in inf)
+    new = []
+    for sample, lineage in rows:
+        row = f"{sample},{lineage}".encode()
+        if row not in existing:
+            existing.add(row)
+            new.append(row)
+    if len(new) > 0:
+        def write(outf):
+            if os.path.exists(lincsv):
+                with open(lincsv, "rb") as inf:
+                    shutil.copyfileobj(inf, outf)
+                    inf.seek(0, os.SEEK_END)
+                    if inf.tell() > 0:
+                        inf.seek(-1, os.SEEK_END)
+                        if inf.read(1) != b"\n":
+                            outf.write(b"\n")
+            outf.write(b"\n".join(new) + b"\n")
+        replace_atomically(lincsv, write)
+    return len(new)
+
+class LineageNotes:
+    """The lineage_notes.txt of a designation repository, with an index of the byte offset just past each lineage's line.
+
+    The index is saved next to the notes with the size and modification time of the file it describes, and is only
+    rebuilt from the notes when they have changed since, such as after pulling the repository.
+    """
+    def __init__(self, notecsv):
+        self.path = notecsv
+        self.index_path = os.path.join(os.path.dirname(os.path.abspath(notecsv)), ".lineage_notes.offsets.json")
+        self.offsets = None
+        if os.path.exists(self.index_path):
+            with open(self.index_path) as inf:
+                saved = json.load(inf)
+            if saved["stat"] == list(self.stat()):
+                self.offsets = saved["offsets"]
+        if self.offsets == None:
+            self.offsets = {}
+            offset = 0
+            with open(notecsv, "rb") as inf:
+                for line in inf:
+                    offset += len(line)
+                    #a child is placed after the first line for its parent.
+                    self.offsets.setdefault(line.strip().split(b"\t")[0].decode(), offset)
+            self.save_index()
+
+    def stat(self):
+        st = os.stat(self.path)
+        return st.st_size, st.st_mtime_ns
+
+    def save_index(self):
+        def write(outf):
+            outf.write(json.dumps({"stat":list(self.stat()), "offsets":self.offsets}).encode())
+        replace_atomically(self.index_path, write)
+
+    def insert(self, notes):
+        """Insert notes after the lines of their parent lineages in a single streaming pass, and replace the file atomically.
+
+        Args:
+            notes (list): (lineage, parent, note) tuples, where lineage is the name the note line starts with. Notes for the
+                same parent keep their order. A parent may be another lineage being inserted; notes whose parent is in
+                neither the file nor notes are added at the end.
+        """
+        children = {}
+        for lineage, parent, note in notes:
+            children.setdefault(parent, []).append((lineage, note))
+        new = set(lineage for lineage, _, _ in notes)
+        size = self.stat()[0]
+        inserts = {}
+        for parent in children:
+            if parent in self.offsets:
+                inserts.setdefault(self.offsets[parent], []).append(parent)
+        #notes of unknown parents go at the end, after any children of the last line.
+        for parent in children:
+            if parent not in self.offsets and parent not in new:
+                inserts.setdefault(size, []).append(parent)
+        placed = {}
+        shifts = []
+        terminated = set()
+        def write(outf):
+            written = 0
+            with open(self.path, "rb") as inf:
+                last = b"\n"
+                for offset in sorted(inserts):
+                    block = inf.read(offset - written)
+                    outf.write(block)
+                    written = offset
+                    last = block[-1:] if len(block) > 0 else last
+                    if last != b"\n":
+                        outf.write(b"\n")
+                        last = b"\n"
+                        terminated.add(offset)
+                    #each note is followed by the notes of its own new children.
+                    stack = [(lineage, note) for parent in inserts[offset] for lineage, note in children[parent]][::-1]
+                    while len(stack) > 0:
+                        lineage, note = stack.pop()
+                        outf.write(note.encode() + b"\n")
+                        placed.setdefault(lineage, outf.tell())
+                        stack.extend(children.get(lineage, [])[::-1])
+                    shifts.append(outf.tell() - offset)
+                shutil.copyfileobj(inf, outf)
+        replace_atomically(self.path, write)
+        #lines ending past an insertion point move by all the bytes inserted up to it.
+        points = sorted(inserts)
+        def shifted(offset):
+            i = bisect.bisect_left(points, offset)
+            #a line that was missing its newline now ends after the one added.
+            return offset + (shifts[i-1] if i > 0 else 0) + (offset in terminated)
+        self.offsets = {lineage:shifted(offset) for lineage, offset in self.offsets.items()}
+        for lineage, offset in placed.items():
+            self.offsets.setdefault(lineage, offset)
+        self.save_index()
+        return len(placed)
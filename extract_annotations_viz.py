@@ -1,15 +1,13 @@
 import sys
 sys.path.append("~/bin:")
-import bte
-import pandas as pd
-t = bte.MATree(sys.argv[1])
-df = pd.read_csv(sys.argv[2],sep='\t')
-def pull_annotations(sample):
-    try:
-        n = t.get_node(sample)
-    except ValueError:
+from tree_index import load_tree_index
+from metadata_store import load_metadata
+#the annotations come from the tree snapshot; the protobuf itself is only parsed if there is none yet.
+index = load_tree_index(sys.argv[1])
+#all columns are written back out as read, so dates are left as text.
+df = load_metadata(sys.argv[2], parse_dates = False)
+for sample in df.strain:
+    if sample not in index.index:
         print("WARNING: Can't load node object and obtain annotations for {}".format(sample))
-        return "None"
-    return n.most_recent_annotation()[-1]
-df['auto_annotation'] = df.strain.apply(pull_annotations)
+df['auto_annotation'] = index.annotation_labels(df.strain, -1, missing = "None")
 df.to_csv(sys.argv[3],sep='\t',index=False)
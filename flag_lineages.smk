@@ -3,9 +3,18 @@ from pathlib import Path
 import pandas as pd
 import datetime as dt
 import numpy as np
+sys.path.insert(0, workflow.basedir)
+from metadata_store import load_metadata
+from tree_index import prune_snapshots
 
 configfile: "config.yaml"
 
+onsuccess:
+    #cached data is kept only for the current contents of files still in use, so daily runs do not accumulate it.
+    if eval(str(config["prune_snapshots"])):
+        removed = prune_snapshots(".tree_snapshots", config["snapshot_max_age"])
+        print(f"Pruned {len(removed)} unused entries from .tree_snapshots")
+
 rule all:
     input:
         "{tree}.jsonl.gz"
@@ -26,6 +35,7 @@ rule open_pull_request:
         "{tree}_metadata.viz.tsv"
     output:
         "{tree}.pullreq.report.tsv"
+    threads: workflow.cores
     run:
         commandstr = "{config[python]} open_pull_request.py -r {config[request_params][designation_repo]} \
             -i {input[0]} -t {input[1]} -s {config[request_params][valid_samples]} -c {config[request_params][representative_number]} \
@@ -40,11 +50,13 @@ rule open_pull_request:
         if eval(str(config["request_params"]["growth_model"]["use_model"])):
             commandstr += " --model_growth \
                            --metadata {input[2]} \
+                           --growth-method {config[request_params][growth_model][method]} \
                            --draws {config[request_params][growth_model][draws]} \
                            --tune {config[request_params][growth_model][tune]} \
                            --target_accept {config[request_params][growth_model][target_accept]} \
                            --min_country_weeks {config[request_params][growth_model][min_country_weeks]} \
-                           --maxperc {config[request_params][growth_model][max_proportion_considered]}"
+                           --maxperc {config[request_params][growth_model][max_proportion_considered]} \
+                           --cores {threads}"
         shell(commandstr)
 
 rule write_issues:
@@ -54,11 +66,12 @@ rule write_issues:
         "{tree}_metadata.viz.tsv"
     output:
         "{tree}.issues.log"
+    threads: workflow.cores
     run:
         if eval(str(config["issue_params"]["local_only"])):
-            shell("{config[python]} write_issues.py --local -i {input[0]} -t {input[1]} -m {input[2]} -n {config[issue_params][number]} -s {config[issue_params][sort_by]} -p {config[issue_params][prefix]} -c {config[issue_params][samples_named]}")
+            shell("{config[python]} write_issues.py --local -i {input[0]} -t {input[1]} -m {input[2]} -n {config[issue_params][number]} -s {config[issue_params][sort_by]} -p {config[issue_params][prefix]} -c {config[issue_params][samples_named]} --threads {threads}")
         else:
-            shell("{config[python]} write_issues.py -i {input[0]} -t {input[1]} -m {input[2]} -n {config[issue_params][number]} -s {config[issue_params][sort_by]} -p {config[issue_params][prefix]} -c {config[issue_params][samples_named]}")
+            shell("{config[python]} write_issues.py -i {input[0]} -t {input[1]} -m {input[2]} -n {config[issue_params][number]} -s {config[issue_params][sort_by]} -p {config[issue_params][prefix]} -c {config[issue_params][samples_named]} --threads {threads}")
 
 rule add_metadata:
     input:
@@ -89,6 +102,7 @@ rule propose:
         "{tree}.proposed.pb"
     log:
         "{tree}.proposal.log"
+    threads: workflow.cores
     run:
         d = {"input":input[0]}
         for k,v in config['lineage_params'].items():
@@ -101,6 +115,7 @@ rule propose:
         d['aaweights'] = input[1]
         d['samples'] = input[2]
         d['verbose'] = True
+        d['threads'] = threads
         d['reference'] = config['reference_genome']
         d['gtf'] = config['reference_gtf']
         d['dump'] = output[0]
@@ -129,18 +144,12 @@ rule compute_region_weights_and_dates:
     output:
         temp("{tree}.sample_weights.tsv")
     run:
-        mdf = pd.read_csv(input[0],sep='\t')
-        def get_dt(dstr):
-            try:
-                if type(dstr) == str:
-                    return dt.datetime.strptime(dstr,"%Y-%m-%d")
-                else:
-                    return dstr
-            except:
-                return np.nan
-        mdf['Date'] = mdf.date.apply(get_dt)
-        mindate = get_dt(config['lineage_params']['earliest_date'])
-        target = mdf[mdf.Date.dt.date >= mindate]
+        #yaml reads an unquoted date as a date already.
+        mindate = config['lineage_params']['earliest_date']
+        if type(mindate) == str:
+            mindate = dt.datetime.strptime(mindate,"%Y-%m-%d").date()
+        #older samples are dropped while the metadata is read.
+        target = load_metadata(input[0], ['strain','country','date'], since = mindate)
         scale = config['lineage_params']['weight_params']['country_weighting']
         invweights = 1/target.country.value_counts(normalize=True)
         to_use = (invweights-invweights.min())/(invweights.max()-invweights.min()) * scale + 1
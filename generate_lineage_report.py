@@ -1,13 +1,20 @@
 import sys
 sys.path.append("./SARS2_RBD_Ab_escape_maps/")
 import bindingcalculator as bc
-import bte
+from tree_index import load_tree_index, snapshot_dir, file_hash, record_snapshot, PathWalker
+from translation import load_translation
 import pandas as pd
 import numpy as np
 import datetime as dt
 import argparse
+import os
+import hashlib
 from urllib import parse
-import requests
+from lapis import LapisClient, DEFAULT_ENDPOINT
+from metadata_store import load_metadata
+import json
+
+ESCAPE_DATA = 'SARS2_RBD_Ab_escape_maps/processed_data/escape_calculator_data.csv'
 
 def argparser():
     parser = argparse.ArgumentParser(description="Compute detailed lineage reports for all existing lineages in the tree.")
@@ -18,6 +25,9 @@ def argparser():
     parser.add_argument("-f", "--reference", default=None, help="Path to a reference fasta file. Use with -g to annotate amino acid changes and immune escape in the expanded output.")
     parser.add_argument("-g", "--gtf", default=None, help="Path to a reference gtf file. Use with -f to annotate amino acid changes and immune escape in the expanded output.")
     parser.add_argument("-d", "--date", default=None, help="Ignore individual samples from before this date when computing reports. Format as %Y-%m-%d")
+    parser.add_argument("--lapis", default=DEFAULT_ENDPOINT, help="Base URL of the LAPIS server used to count available sequences, or a tab-separated file of lineage, mutations and count to use instead. Default {}".format(DEFAULT_ENDPOINT))
+    parser.add_argument("--lapis-threads", type=int, default=8, help="Number of LAPIS queries to run at once. Default 8")
+    parser.add_argument("--lapis-cache", default=None, help="Path to a file caching LAPIS responses for a day. Default is a file kept with the tree snapshots.")
     args = parser.parse_args()
     return args
 
@@ -64,43 +74,82 @@ def update_aa_haplotype(caas, naas):
                 caas.append(naa)
     return caas
 
-def fill_output_table(t,pdf,mdf,fa_file=None,gtf_file=None,mdate=None):
+class EscapeScorer:
+    """Antibody binding retained for sets of escaped spike sites, computed once per distinct set.
+
+    Scores are kept for the run and, given a cache directory, saved between runs in a file named by a hash of the
+    escape data they were computed from, so they are recomputed when the data changes.
+    """
+    def __init__(self, calculator, data_file, cache_dir = None):
+        self.calculator = calculator
+        self.data_key = file_hash(data_file) if os.path.exists(data_file) else data_file
+        self.cache_file = None
+        if cache_dir != None:
+            self.cache_file = os.path.join(cache_dir, "escape_scores.{}.json".format(hashlib.sha256(self.data_key.encode()).hexdigest()))
+        self.scores = {}
+        if self.cache_file != None and os.path.exists(self.cache_file):
+            with open(self.cache_file) as inf:
+                saved = json.load(inf)
+            if saved.get("data") == self.data_key:
+                self.scores = {frozenset(int(s) for s in sites.split(",") if s != ""):score for sites, score in saved["scores"].items()}
+
+    def score_all(self, site_sets):
+        """Return the binding retained for each frozenset of sites in site_sets, calculating only the sets not seen before.
+        """
+        new = set(site_sets).difference(self.scores)
+        for sites in new:
+            self.scores[sites] = self.calculator.binding_retained(sorted(sites))
+        if len(new) > 0 and self.cache_file != None:
+            os.makedirs(os.path.dirname(os.path.abspath(self.cache_file)), exist_ok=True)
+            tmp = self.cache_file + ".tmp.{}".format(os.getpid())
+            with open(tmp, "w") as outf:
+                json.dump({"data":self.data_key, "scores":{",".join(map(str, sorted(sites))):score for sites, score in self.scores.items()}}, outf)
+            os.replace(tmp, self.cache_file)
+        return [self.scores[sites] for sites in site_sets]
+
+def fill_output_table(index,pdf,mdf,fa_file=None,gtf_file=None,mdate=None,cache_dir=None,lapis=None):
     print("Filling out metadata with terminal lineages.")
-    def get_latest_lineage(s):
-        for anc in t.rsearch(s):
-            if len(anc.annotations) > 0:
-                if len(anc.annotations[0]) > 0:
-                    return anc.annotations[0]
-    mdf['date'] = mdf.date.apply(get_date)
+    if not pd.api.types.is_datetime64_any_dtype(mdf.date):
+        mdf['date'] = mdf.date.apply(get_date)
     if mdate != None:
         mdf = mdf[mdf.date > dt.datetime.strptime(mdate,"%Y-%m-%d")]
-    mdf['autolin'] = mdf.strain.apply(get_latest_lineage)
+    #the closest first-column annotation above each sample, read from a single pass over the tree.
+    mdf['autolin'] = index.annotation_labels(mdf.strain, 0, include_self = False)
     mdf.set_index('strain',inplace=True)
+    print("Aggregating metadata by lineage.")
+    #every per-lineage summary below comes from one grouping of the metadata by parent and by proposed lineage.
+    #groups keep the original row order, so ties in the country counts are ordered as for a filtered frame.
+    parent_groups = mdf.groupby('pango_lineage_usher')
+    parent_sizes = parent_groups.size().to_dict()
+    parent_ranges = parent_groups.date.agg(['min','max'])
+    child_groups = mdf[mdf.autolin.isin(set(pdf.proposed_sublineage))].groupby('autolin')
+    child_ranges = child_groups.date.agg(['min','max'])
+    child_regions = child_groups.country.apply(lambda c:",".join(list(c.value_counts().index))).to_dict()
+    child_region_percents = child_groups.country.apply(lambda c:",".join([str(round(p,2)) for p in c.value_counts(normalize=True)])).to_dict()
+    if 'host' in mdf.columns:
+        child_hosts = child_groups.host.nunique().to_dict()
+    else:
+        child_hosts = {}
     #parent lineage size has to be inclusive to get a sensible percentage.
     def parent_lineage_size(lin):
-        return mdf[mdf.pango_lineage_usher == lin].shape[0]
+        return parent_sizes.get(lin, 0)
     print("Computing sublineage percentages.")
     pdf['parent_lineage_size'] = pdf.parent.apply(parent_lineage_size)
     pdf['proposed_sublineage_percent'] = round(pdf.proposed_sublineage_size/pdf.parent_lineage_size,2)
-    def parsimony_parent(row):
-        parent_parsimony = sum([len(n.mutations) for n in t.depth_first_expansion(row.parent_nid)])
-        return parent_parsimony
-    def parsimony_child(row):
-        child_parsimony = sum([len(n.mutations) for n in t.depth_first_expansion(row.proposed_sublineage_nid)])
-        return child_parsimony
     print("Computing parsimony percentages.")
-    pdf['parent_parsimony'] = pdf.apply(parsimony_parent,axis=1)
-    pdf['proposed_sublineage_parsimony'] = pdf.apply(parsimony_child,axis=1)
+    #subtree mutation totals are differences of the running mutation count over the index.
+    pdf['parent_parsimony'] = index.subtree_mutation_count([index.ordinal(nid) for nid in pdf.parent_nid])
+    pdf['proposed_sublineage_parsimony'] = index.subtree_mutation_count([index.ordinal(nid) for nid in pdf.proposed_sublineage_nid])
     pdf['parsimony_percent'] = round(pdf.proposed_sublineage_parsimony/pdf.parent_parsimony,2)
     def get_start_ends(row):
-        try:
-            parent_dates = mdf[mdf.pango_lineage_usher == row.parent].date.dropna()
-            child_dates = mdf[mdf.autolin == row.proposed_sublineage].date.dropna()
-            return min(parent_dates),max(parent_dates),min(child_dates),max(child_dates)
-        except KeyboardInterrupt:
-            raise KeyboardInterrupt
-        except ValueError:
-            return np.nan,np.nan,np.nan,np.nan    
+        #lineages without any dated samples have no range.
+        if row.parent not in parent_ranges.index or row.proposed_sublineage not in child_ranges.index:
+            return np.nan,np.nan,np.nan,np.nan
+        parent_range = parent_ranges.loc[row.parent]
+        child_range = child_ranges.loc[row.proposed_sublineage]
+        if parent_range.isna().any() or child_range.isna().any():
+            return np.nan,np.nan,np.nan,np.nan
+        return parent_range['min'],parent_range['max'],child_range['min'],child_range['max']
     print("Computing start and end dates.")
     applied_pdf = pdf.apply(lambda row: get_start_ends(row), axis='columns', result_type='expand')
     pdf = pd.concat([pdf, applied_pdf], axis='columns')
@@ -108,44 +157,29 @@ def fill_output_table(t,pdf,mdf,fa_file=None,gtf_file=None,mdate=None):
     pdf['log_score'] = np.log10(pdf.proposed_sublineage_score)
     print("Tracking country composition.")
     def get_regions(lin):
-        try:
-            return ",".join(list(mdf[mdf.autolin == lin].country.value_counts().index))
-        except KeyError:
-            return np.nan
-    def get_regions_percents(lin):        
-        try:
-            return ",".join([str(round(p,2)) for p in mdf[mdf.autolin == lin].country.value_counts(normalize=True)])
-        except KeyError:
-            return np.nan
+        return child_regions.get(lin, "")
+    def get_regions_percents(lin):
+        return child_region_percents.get(lin, "")
     pdf['child_regions'] = pdf.proposed_sublineage.apply(get_regions)
     pdf['child_regions_count'] = pdf.child_regions.apply(lambda x:x.count(",")+1)
     pdf['child_region_percents'] = pdf.proposed_sublineage.apply(get_regions_percents)
     def host_jump(lin):
-        try:
-            return mdf[mdf.autolin == lin].host.nunique() > 1
-        except:
-            return False
+        return child_hosts.get(lin, 0) > 1
     print("Identifying host jumps.")
     pdf['host_jump'] = pdf.proposed_sublineage.apply(host_jump)
+    print("Walking proposal paths.")
+    #one walk per proposal collects everything the remaining columns need from the path between it and its parent.
+    walker = PathWalker(index)
+    walks = [walker.walk(index.ordinal(c), index.ordinal(p)) for c, p in zip(pdf.proposed_sublineage_nid, pdf.parent_nid)]
     print("Generating cov-spectrum URLs.")
-    def generate_url(row):
-        child_mset = t.get_haplotype(row.proposed_sublineage_nid)
-        parent_mset = t.get_haplotype(row.parent_nid)
-        net_mset = child_mset - parent_mset
+    def generate_url(row, net_mset):
         mset_str = "[{}-of:{}]".format(len(net_mset), ", ".join([m[1:] for m in net_mset]))
         query = parse.urlencode([('variantQuery','nextcladePangoLineage:' + row.parent + "*&" + mset_str)])
         url = "https://cov-spectrum.org/explore/World/AllSamples/AllTimes/variants?" + query
         return url
-    pdf['link'] = pdf.apply(generate_url,axis=1)
+    pdf['link'] = [generate_url(row, w[3]) for row, w in zip(pdf.itertuples(), walks)]
     print("Collecting mutations.")
-    def get_separating_mutations(row):
-        hapstring = []
-        for n in t.rsearch(row.proposed_sublineage_nid,True):
-            if n.id == row.parent_nid:
-                break
-            hapstring.append(",".join(n.mutations))
-        return ">".join(hapstring[::-1])
-    pdf['mutations'] = pdf.apply(get_separating_mutations,axis=1)
+    pdf['mutations'] = [w[0] for w in walks]
     def get_growth_score(row):
         try:
             td = (row.latest_child - row.earliest_child)
@@ -156,76 +190,54 @@ def fill_output_table(t,pdf,mdf,fa_file=None,gtf_file=None,mdate=None):
     pdf['growth_index'] = pdf.apply(get_growth_score,axis=1)
     if gtf_file != None and fa_file != None:
         print("Performing translation and computing antibody binding scores.")
-        translation = t.translate(fasta_file = fa_file, gtf_file = gtf_file)
-        calculator = bc.BindingCalculator(csv_or_url='SARS2_RBD_Ab_escape_maps/processed_data/escape_calculator_data.csv')
+        #changes are only read on the paths from each proposed sublineage to the root.
+        paths = index.ancestor_mask([index.ordinal(nid) for nid in pdf.proposed_sublineage_nid])
+        translation = load_translation(index, fa_file, gtf_file, cache_dir, paths)
+        calculator = bc.BindingCalculator(csv_or_url=ESCAPE_DATA)
+        scorer = EscapeScorer(calculator, ESCAPE_DATA, cache_dir)
+        if getattr(index, "tree_file", None) != None and cache_dir != None and os.path.abspath(cache_dir) == snapshot_dir(index.tree_file):
+            #scores made with earlier escape data are pruned as they are replaced.
+            record_snapshot(scorer.cache_file, index.tree_file, "escape_scores")
+        def spike_sites(aas):
+            return frozenset(a.aa_index for a in aas if a.gene == 'S' and a.aa_index in calculator.sites and a.original_aa != a.alternative_aa)
+        #proposals sharing a parent share its amino acid haplotype.
+        parent_haplotypes = {}
+        def parent_haplotype(o):
+            if o not in parent_haplotypes:
+                parent_haplotypes[o] = []
+                for n in walker.path(o):
+                    parent_haplotypes[o] = update_aa_haplotype(parent_haplotypes[o], translation.get_changes(n))
+            return parent_haplotypes[o]
         hstrs = []
-        cev = []
-        pev = []
-        nev = []
-        for i, row in pdf.iterrows():
+        csites = []
+        psites = []
+        for child, parent in zip(pdf.proposed_sublineage_nid, pdf.parent_nid):
+            #further filter aa changes in orf1a/b so that they're properly processed for taxonium viewing and not counted redundantly
+            #in our code, ORF1a changes are annotated as both ORF1a and ORF1ab, ORF1b are annotated as ORF1ab only.
             child_aas = []
-            parent_aas = []
-            all_aas = []
-            past_parent = False
-            for n in t.rsearch(row.proposed_sublineage_nid,True):
-                #further filter aa changes in orf1a/b so that they're properly processed for taxonium viewing and not counted redundantly
-                #in our code, ORF1a changes are annotated as both ORF1a and ORF1ab, ORF1b are annotated as ORF1ab only.
-                alla = translation.get(n.id,[])
-                if n.id == row.parent_nid:
-                    past_parent = True
-                if past_parent:
-                    #only mutations at or behind the parent node contribute to its haplotype.
-                    parent_aas = update_aa_haplotype(parent_aas, alla)
-                else:
-                    child_aas = update_aa_haplotype(child_aas, alla)
-            hstr = ",".join([aa.aa_string() for aa in child_aas])
-            cspikes = [a.aa_index for a in all_aas if a.gene == 'S' and a.aa_index in calculator.sites and a.original_aa != a.alternative_aa]
-            pspikes = [a.aa_index for a in parent_aas if a.gene == 'S' and a.aa_index in calculator.sites and a.original_aa != a.alternative_aa]
-            child_escape = calculator.binding_retained(cspikes)
-            parent_escape = calculator.binding_retained(pspikes)
-            net_escape_gain = parent_escape - child_escape
-            hstrs.append(hstr)
-            cev.append(child_escape)
-            pev.append(parent_escape)
-            nev.append(net_escape_gain)
+            for n in walker.path(index.ordinal(child), index.ordinal(parent)):
+                child_aas = update_aa_haplotype(child_aas, translation.get_changes(n))
+            parent_aas = parent_haplotype(index.ordinal(parent))
+            #the full child haplotype continues the walk through the parent's.
+            all_aas = update_aa_haplotype(list(child_aas), parent_aas)
+            hstrs.append(",".join([aa.aa_string() for aa in child_aas]))
+            csites.append(spike_sites(all_aas))
+            psites.append(spike_sites(parent_aas))
+        #each distinct set of escape sites is scored once.
+        cev = scorer.score_all(csites)
+        pev = scorer.score_all(psites)
+        nev = [p - c for c, p in zip(cev, pev)]
         pdf['aav'] = hstrs
         pdf['sublineage_escape'] = cev
         pdf['parent_escape'] = pev
         pdf['net_escape_gain'] = nev
-    def get_reversions(subnid):
-        reversions = []
-        allm = set()
-        past_parent = False
-        for n in t.rsearch(subnid,True):
-            if n.id != subnid:
-                if any([len(a) > 0 for a in n.annotations]):
-                    past_parent = True
-            if past_parent:
-                for m in n.mutations:
-                    opposite = m[-1] + m[1:-1] + m[0]
-                    if opposite in allm:
-                        #record any mutations between the sublineage and the parent that are opposite of a parent mutation.
-                        reversions.append(opposite)
-            else:
-                for m in n.mutations:
-                    allm.add(m)
+    def format_reversions(reversions):
         if len(reversions) > 0:
             return ",".join(reversions)
         else:
             return "No Reversions"
-    pdf['reversions'] = pdf.proposed_sublineage_nid.apply(get_reversions)
-    def get_mset(mutations):
-        mhap = []
-        locs = set()
-        for mset in reversed(mutations.split(">")):
-            for m in mset.split(','):
-                if len(m) > 0:
-                    location = int(m[1:-1])
-                    if location not in locs:
-                        locs.add(location)
-                        mhap.append(m[1:])
-        return ','.join(mhap)
-    pdf['mset'] = pdf.mutations.apply(get_mset)
+    pdf['reversions'] = [format_reversions(w[2]) for w in walks]
+    pdf['mset'] = [w[1] for w in walks]
     #remove any entries that have no mutations with respect to the parent.
     trackrev = open("reversion_proposals_blocked.log","w+")
     def log_mset(row):
@@ -236,21 +248,21 @@ def fill_output_table(t,pdf,mdf,fa_file=None,gtf_file=None,mdate=None):
             return False
     pdf = pdf[pdf.apply(log_mset,axis=1)]
     trackrev.close()
-    def get_representative_download(row):
-        #query on parent lineage + mutations instead
-        #and use requests to see how many are available.
-        check_query = f"https://lapis.cov-spectrum.org/open/v1/sample/aggregated?pangoLineage={row.parent}&nucMutations={row.mset}"
-        response = requests.get(check_query)
-        if response.status_code != requests.codes.ok:
-            print(f"WARNING: Lapis Error Status Code {response.status_code} for link {check_query}")
+    #query on parent lineage + mutations instead to see how many are available; all proposals are queried together.
+    if lapis == None:
+        lapis = LapisClient()
+    counts = lapis.counts(list(zip(pdf.parent, pdf.mset)))
+    def get_representative_download(row, status, count):
+        if count == None:
+            print(f"WARNING: Lapis Error Status Code {status} for {lapis.describe(row.parent, row.mset)}")
             return np.nan
-        elif response.json()['data'][0]['count'] == 0:
+        elif count == 0:
             print(f"No samples available for lineage proposal {row.proposed_sublineage}")
             return np.nan
         else:
             #return the fasta download version of this link.
             return f"https://lapis.cov-spectrum.org/open/v1/sample/fasta?pangoLineage={row.parent}&nucMutations={row.mset}"
-    pdf['seqlink'] = pdf.apply(get_representative_download,axis=1)
+    pdf['seqlink'] = [get_representative_download(row, status, count) for row, (status, count) in zip(pdf.itertuples(), counts)]
     def get_epi_isls(row):
         #open version for if we ever have problems with the queries
         #query = f"https://lapis.cov-spectrum.org/open/v1/sample/gisaid-epi-isl?pangoLineage={row.parent}&nucMutations={row.mset}"
@@ -268,10 +280,18 @@ def fill_output_table(t,pdf,mdf,fa_file=None,gtf_file=None,mdate=None):
 
 def main():
     args = argparser()
-    mdf = pd.read_csv(args.metadata,sep='\t')
-    t = bte.MATree(args.input)
+    #samples from before --date are dropped while the metadata is read; fill_output_table only keeps those from after it.
+    since = None if args.date == None else dt.datetime.strptime(args.date,"%Y-%m-%d") + dt.timedelta(days=1)
+    mdf = load_metadata(args.metadata, ['strain','date','country','host','pango_lineage_usher'], since = since)
     pdf = pd.read_csv(args.proposed,sep='\t')
-    odf = fill_output_table(t,pdf,mdf,args.reference,args.gtf,args.date)
+    index = load_tree_index(args.input)
+    lapis_cache = args.lapis_cache
+    if lapis_cache == None:
+        lapis_cache = os.path.join(snapshot_dir(args.input), "lapis_counts.json")
+        #the cache is kept while the tree it was used with is, and pruned with its snapshot.
+        record_snapshot(lapis_cache, args.input, "lapis")
+    lapis = LapisClient(args.lapis, lapis_cache, args.lapis_threads)
+    odf = fill_output_table(index,pdf,mdf,args.reference,args.gtf,args.date,snapshot_dir(args.input),lapis)
     odf.to_csv(args.output,sep='\t',index=False)
 
 if __name__ == "__main__":
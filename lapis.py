@@ -0,0 +1,91 @@
+import os
+import json
+import time
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from concurrent.futures import ThreadPoolExecutor
+
+DEFAULT_ENDPOINT = "https://lapis.cov-spectrum.org/open/v1"
+
+class LapisClient:
+    """Counts of samples matching a lineage and set of nucleotide mutations, queried from LAPIS.
+
+    Queries share one pooled session, run a bounded number at a time, and are retried with backoff on
+    connection errors and transient server errors. Successful answers are kept in an optional on-disk
+    cache keyed by (lineage, mutations) for max_age seconds.
+
+    The endpoint is either the base URL of a LAPIS server (the public one, or a local stand-in) or the path
+    to a tab-separated fixture file with lineage, mutations and count columns, for tests and offline runs.
+    """
+    def __init__(self, endpoint = DEFAULT_ENDPOINT, cache_file = None, threads = 8, retries = 3, backoff = 1.0, timeout = 30, max_age = 86400):
+        self.endpoint = endpoint.rstrip("/")
+        self.threads = threads
+        self.timeout = timeout
+        self.fixture = None
+        self.session = None
+        if not self.endpoint.startswith("http"):
+            self.fixture = {}
+            with open(endpoint) as inf:
+                for entry in inf:
+                    parent, mset, count = entry.rstrip("\n").split("\t")
+                    self.fixture[(parent, mset)] = int(count)
+        else:
+            retry = Retry(total=retries, backoff_factor=backoff, status_forcelist=(429, 500, 502, 503, 504), raise_on_status=False)
+            self.session = requests.Session()
+            self.session.mount("http://", HTTPAdapter(pool_maxsize=threads, max_retries=retry))
+            self.session.mount("https://", HTTPAdapter(pool_maxsize=threads, max_retries=retry))
+        self.cache_file = cache_file
+        self.max_age = max_age
+        self.cache = {}
+        if cache_file != None and os.path.exists(cache_file):
+            with open(cache_file) as inf:
+                self.cache = json.load(inf)
+
+    def query_url(self, parent, mset):
+        return f"{self.endpoint}/sample/aggregated?pangoLineage={parent}&nucMutations={mset}"
+
+    def describe(self, parent, mset):
+        """Return where the count of a query comes from, for log messages: its URL, or its key in the fixture file.
+        """
+        if self.fixture != None:
+            return f"fixture {self.endpoint} entry {parent} {mset}"
+        return f"link {self.query_url(parent, mset)}"
+
+    def count(self, parent, mset):
+        """Return the status of the query and the number of matching samples, or None if the query failed.
+
+        The status is an HTTP status code, or the text of the error if no response was received.
+        """
+        if self.fixture != None:
+            if (str(parent), str(mset)) not in self.fixture:
+                return 404, None
+            return requests.codes.ok, self.fixture[(str(parent), str(mset))]
+        key = f"{parent}\t{mset}"
+        cached = self.cache.get(key)
+        if cached != None and time.time() - cached[1] < self.max_age:
+            return requests.codes.ok, cached[0]
+        try:
+            response = self.session.get(self.query_url(parent, mset), timeout=self.timeout)
+        except requests.exceptions.RequestException as e:
+            return str(e), None
+        if response.status_code != requests.codes.ok:
+            return response.status_code, None
+        count = response.json()['data'][0]['count']
+        self.cache[key] = (count, time.time())
+        return response.status_code, count
+
+    def counts(self, queries):
+        """Run count for each (parent, mset) pair concurrently, returning the results in order, then save the cache.
+        Expired answers are dropped from the cache as it is saved.
+        """
+        with ThreadPoolExecutor(max_workers=self.threads) as pool:
+            results = list(pool.map(lambda q:self.count(*q), queries))
+        if self.cache_file != None:
+            now = time.time()
+            self.cache = {k:v for k, v in self.cache.items() if now - v[1] < self.max_age}
+            tmp = self.cache_file + ".tmp.{}".format(os.getpid())
+            with open(tmp, "w") as outf:
+                json.dump(self.cache, outf)
+            os.replace(tmp, self.cache_file)
+        return results
@@ -0,0 +1,237 @@
+import os
+import json
+import shutil
+import tempfile
+import datetime as dt
+import numpy as np
+import pandas as pd
+from tree_index import file_hash, snapshot_dir, record_snapshot
+
+def parse_date(d):
+    """Return d as a datetime if it is a complete %Y-%m-%d date, otherwise NaT.
+    """
+    try:
+        return dt.datetime.strptime(d,"%Y-%m-%d")
+    except:
+        return pd.NaT
+
+class MetadataStore:
+    """A metadata table stored column by column, so scripts sharing a metadata file parse it once.
+
+    Text columns are kept as integer codes into their distinct values and numeric columns as arrays, both memory-mapped
+    on load. The date column is also kept parsed as datetime64 values, with incomplete or invalid dates as NaT.
+    """
+    VERSION = 2
+
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, "columns.json")) as inf:
+            self.kinds = dict(json.load(inf))
+        self.columns = list(self.kinds)
+        self.position = {c:i for i, c in enumerate(self.columns)}
+        self.strain_rows = None
+        self.size = len(np.load(os.path.join(path, "0.npy"), mmap_mode='r')) if len(self.columns) > 0 else 0
+
+    @classmethod
+    def build(cls, metadata_file, path):
+        """Read a tab-separated metadata file and write it as a store directory at path.
+
+        The store is assembled in a temporary directory and renamed into place, as tree snapshots are, once every
+        column has been read back from it.
+        """
+        #the types of columns are inferred from the whole file, so a column is never part numbers and part text.
+        df = pd.read_csv(metadata_file, sep='\t', low_memory=False)
+        parent = os.path.dirname(os.path.abspath(path))
+        os.makedirs(parent, exist_ok=True)
+        tmp = tempfile.mkdtemp(dir=parent, prefix=".tmp.")
+        try:
+            kinds = []
+            for i, c in enumerate(df.columns):
+                if not (pd.api.types.is_numeric_dtype(df[c]) or pd.api.types.is_bool_dtype(df[c])):
+                    #values are stored as text, so they are made text first to keep one code per stored value.
+                    codes, values = pd.factorize(df[c].map(str, na_action='ignore'))
+                    np.save(os.path.join(tmp, f"{i}.npy"), codes.astype(np.int32))
+                    with open(os.path.join(tmp, f"{i}.values.json"), "w") as outf:
+                        json.dump([str(v) for v in values], outf)
+                    kinds.append((c, "text"))
+                    if c == 'date':
+                        #each distinct date string is only parsed once.
+                        parsed = pd.DatetimeIndex([parse_date(v) for v in values]).values.astype("datetime64[ns]")
+                        dates = np.where(codes >= 0, parsed[codes], np.datetime64("NaT"))
+                        np.save(os.path.join(tmp, f"{i}.datetime.npy"), dates)
+                else:
+                    np.save(os.path.join(tmp, f"{i}.npy"), df[c].values)
+                    kinds.append((c, "array"))
+            with open(os.path.join(tmp, "columns.json"), "w") as outf:
+                json.dump(kinds, outf)
+            del df
+            check = cls(tmp)
+            for c in check.columns:
+                check.column(c)
+            os.chmod(tmp, 0o755)
+            os.rename(tmp, path)
+        except OSError:
+            #another process finished the same store first.
+            if not os.path.isdir(path):
+                raise
+        finally:
+            if os.path.isdir(tmp):
+                shutil.rmtree(tmp)
+        return cls(path)
+
+    def codes(self, column):
+        """Return the memory-mapped integer codes of a text column and its distinct values; missing entries have code -1.
+        """
+        i = self.position[column]
+        with open(os.path.join(self.path, f"{i}.values.json")) as inf:
+            values = json.load(inf)
+        return np.load(os.path.join(self.path, f"{i}.npy"), mmap_mode='r'), values
+
+    def dates(self):
+        """Return the memory-mapped parsed dates, or None if the table has no text date column.
+        """
+        if 'date' not in self.position or not os.path.exists(os.path.join(self.path, f"{self.position['date']}.datetime.npy")):
+            return None
+        return np.load(os.path.join(self.path, f"{self.position['date']}.datetime.npy"), mmap_mode='r')
+
+    def column(self, column, categorical = False, parse_dates = True, rows = None):
+        """Return one column as a Series.
+
+        Args:
+            column (str): Name of the column.
+            categorical (bool): Return a text column as a pandas Categorical instead of its values.
+            parse_dates (bool): Return the date column as datetime64 values instead of the original text.
+            rows (np.array): Positions of the rows to return. Default all.
+        """
+        i = self.position[column]
+        if column == 'date' and parse_dates and self.dates() is not None:
+            values = self.dates()
+            return pd.Series(np.array(values if rows is None else values[rows]), name=column)
+        if self.kinds[column] == "array":
+            values = np.load(os.path.join(self.path, f"{i}.npy"), mmap_mode='r')
+            return pd.Series(values if rows is None else values[rows], name=column)
+        codes, values = self.codes(column)
+        if rows is not None:
+            codes = codes[rows]
+        cat = pd.Categorical.from_codes(codes, pd.Index(values, dtype=object))
+        if categorical:
+            return pd.Series(cat, name=column)
+        return pd.Series(np.asarray(cat, dtype=object), name=column)
+
+    def frame(self, columns = None, categorical = (), parse_dates = True, rows = None):
+        """Return a DataFrame of the given columns, by default all of them, and rows, by default all of them.
+        Requested columns the table lacks are left out.
+        """
+        if columns == None:
+            columns = self.columns
+        return pd.DataFrame({c:self.column(c, c in categorical, parse_dates, rows) for c in columns if c in self.position})
+
+    def select(self, since = None, strains = None):
+        """Return the positions of the rows dated on or after since and naming one of strains, reading only those two columns.
+        Rows without a complete date never pass a date filter.
+        """
+        keep = np.ones(self.size, dtype=bool)
+        if since != None:
+            dates = self.dates()
+            if dates is None:
+                keep[:] = False
+            else:
+                keep &= dates >= np.datetime64(pd.Timestamp(since))
+        if strains != None:
+            codes, values = self.codes('strain')
+            allowed = np.append(pd.Index(values).isin(list(strains)), False)
+            keep &= allowed[codes]
+        return np.flatnonzero(keep)
+
+    def rows(self, strains):
+        """Return the row of the first entry for each strain in strains, or -1 for strains not in the table.
+        """
+        if self.strain_rows == None:
+            codes, values = self.codes('strain')
+            first = np.full(len(values), -1, dtype=np.int64)
+            order = np.arange(len(codes))[codes >= 0][::-1]
+            first[codes[order]] = order
+            self.strain_rows = (pd.Index(values), first)
+        values, first = self.strain_rows
+        found = values.get_indexer(list(strains))
+        return np.where(found >= 0, first[found], -1)
+
+def metadata_path(metadata_file):
+    """Return the store directory for a metadata file, keyed by the hash of its contents.
+    """
+    return os.path.join(snapshot_dir(metadata_file), "metadata.{}.v{}".format(file_hash(metadata_file), MetadataStore.VERSION))
+
+def load_metadata_store(metadata_file, path = None):
+    """Open the store for a metadata file, building it from the file first if there is none.
+    """
+    if path == None:
+        path = metadata_path(metadata_file)
+    if os.path.isdir(path):
+        store = MetadataStore(path)
+    else:
+        store = MetadataStore.build(metadata_file, path)
+    record_snapshot(path, metadata_file, "metadata")
+    return store
+
+def stream_metadata(metadata_file, columns = None, categorical = (), parse_dates = True, since = None, strains = None, chunksize = 100000):
+    """Read a tab-separated metadata file, optionally gzipped, a chunk at a time, keeping only the rows dated on or after
+    since and naming one of strains. Memory use follows the rows kept rather than the size of the file.
+
+    Arguments are as for load_metadata.
+    """
+    header = pd.read_csv(metadata_file, sep='\t', nrows=0).columns
+    if columns == None:
+        columns = list(header)
+    usecols = [c for c in columns if c in header]
+    read = list(usecols)
+    for c in ('date' if since != None else None, 'strain' if strains != None else None):
+        if c in header and c not in read:
+            read.append(c)
+    if strains != None:
+        strains = set(strains)
+    parsed = {}
+    kept = []
+    for chunk in pd.read_csv(metadata_file, sep='\t', usecols=read, chunksize=chunksize):
+        keep = np.ones(chunk.shape[0], dtype=bool)
+        if 'date' in chunk.columns and (since != None or parse_dates):
+            #each distinct date string is only parsed once over the whole file.
+            dates = pd.to_datetime(chunk.date.map(lambda d:parsed[d] if d in parsed else parsed.setdefault(d, parse_date(d)))).astype("datetime64[ns]")
+            if since != None:
+                keep &= (dates >= pd.Timestamp(since)).values
+            if parse_dates:
+                chunk = chunk.assign(date=dates.values)
+        elif since != None:
+            keep[:] = False
+        if strains != None:
+            keep &= chunk.strain.isin(strains).values
+        kept.append(chunk.loc[keep, usecols])
+    if len(kept) == 0:
+        return pd.DataFrame(columns=usecols)
+    df = pd.concat(kept, ignore_index=True)
+    for c in categorical:
+        if c in df.columns:
+            df[c] = df[c].astype("category")
+    return df
+
+def load_metadata(metadata_file, columns = None, categorical = (), parse_dates = True, since = None, strains = None):
+    """Load columns of a metadata file through its store, with the date column already parsed.
+
+    Filtered loads read only the matching rows from the store. If the file has no store yet they stream the file
+    instead of building one, so a run that keeps a small part of a large file never holds all of it.
+
+    Args:
+        metadata_file (str): Path to the tab-separated metadata file.
+        columns (list): Columns to load. Default all; columns the table lacks are left out.
+        categorical (tuple): Text columns to return as pandas Categoricals, such as country, host or pango_lineage_usher.
+        parse_dates (bool): Return dates as datetime64 values rather than the original text.
+        since (datetime): Keep only samples dated on or after this day. Samples without a complete date are dropped.
+        strains (iterable): Keep only these samples.
+    """
+    path = metadata_path(metadata_file)
+    if since == None and strains == None:
+        return load_metadata_store(metadata_file, path).frame(columns, categorical, parse_dates)
+    if not os.path.isdir(path):
+        return stream_metadata(metadata_file, columns, categorical, parse_dates, since, strains)
+    store = MetadataStore(path)
+    record_snapshot(path, metadata_file, "metadata")
+    return store.frame(columns, categorical, parse_dates, store.select(since, strains))
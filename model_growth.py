@@ -1,55 +1,232 @@
+import os
+import sys
+import tempfile
 import pandas as pd
 import numpy as np
-import pymc3 as pm
-
-def get_growth_model(df, targets = [], min_data = 2, target_accept = 0.9, tune = 1500, draws = 1000, maxperc = .1):
-    #prepare the dataset overall.
-    rc = df.groupby(['country','auto_annotation',pd.Grouper(key='date', freq='1W')]).strain.count().reset_index()
-    rc = rc.rename({"strain":"count"},axis=1).sort_values("date")
-    cc = rc.groupby(["date","country"])['count'].sum().to_dict()
-    rc['country_count'] = rc.apply(lambda row:cc.get((row.date,row.country)),axis=1)
-    rc['country_perc'] = rc['count'] / rc.country_count
-    rc = rc[rc.country_perc <= maxperc]
+from concurrent.futures import ProcessPoolExecutor
+from tree_index import file_hash, snapshot_dir, record_snapshot
+from metadata_store import load_metadata
+
+COUNTS_VERSION = 1
+
+def get_weekly_counts(df):
+    """Return the number of samples of each annotation in each country and week, with the total for that country and week.
+
+    Weeks run Monday to Sunday and are numbered from the week of 1970-01-05. Samples without a complete date, country
+    or annotation are left out, of both the counts and the totals.
+    """
+    df = df[['country','auto_annotation','date']].dropna()
+    week = (df.date.values.astype("datetime64[D]") - np.datetime64("1970-01-05")) // np.timedelta64(7, "D")
+    rc = df.assign(week=week.astype(np.int64)).groupby(['country','auto_annotation','week'], observed=True).size().reset_index(name='count')
+    rc['country_count'] = rc.groupby(['country','week'], observed=True)['count'].transform('sum')
+    return rc
+
+def weekly_counts_path(metadata_file):
+    """Return the cache file for the weekly counts of a metadata file, keyed by the hash of its contents.
+    """
+    return os.path.join(snapshot_dir(metadata_file), "weekly_counts.{}.v{}.npz".format(file_hash(metadata_file), COUNTS_VERSION))
+
+def load_weekly_counts(metadata_file, df = None):
+    """Return the weekly counts of a metadata file from its cache, computing and caching them first if there are none.
+
+    Args:
+        metadata_file (str): Path to the metadata file, which should have an auto_annotation column.
+        df (pd.DataFrame): The already loaded metadata, if any. Only used when nothing is cached.
+    """
+    path = weekly_counts_path(metadata_file)
+    if os.path.exists(path):
+        with np.load(path) as cached:
+            rc = pd.DataFrame({c:cached[c] for c in ['country','auto_annotation','week','count','country_count']})
+        record_snapshot(path, metadata_file, "weekly_counts")
+        return rc.astype({'country':object, 'auto_annotation':object})
+    if df is None:
+        df = load_metadata(metadata_file, ['strain','country','date','auto_annotation'])
+    rc = get_weekly_counts(df)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp = tempfile.NamedTemporaryFile(dir=os.path.dirname(path), prefix=".tmp.", suffix=".npz", delete=False)
+    try:
+        with tmp as outf:
+            np.savez(outf, country=np.asarray(rc.country, dtype=str), auto_annotation=np.asarray(rc.auto_annotation, dtype=str), week=rc.week.values, count=rc['count'].values, country_count=rc.country_count.values)
+        os.replace(tmp.name, path)
+    finally:
+        if os.path.exists(tmp.name):
+            os.remove(tmp.name)
+    record_snapshot(path, metadata_file, "weekly_counts")
+    return rc
+
+def get_growth_data(rc, targets = [], min_data = 2, maxperc = .1):
+    """Return the week index, country sample count and lineage sample count of each usable country-week, by annotation.
+
+    Args:
+        rc (pd.DataFrame): Weekly counts, as from get_weekly_counts.
+    """
+    rc = rc[rc['count'] / rc.country_count <= maxperc]
     #if a specific list of target lineages was specified, subsample to those. 
     #it's okay to subsample now that I've collected my full country count.
     if len(targets) > 0:
-        rc = rc[rc.auto_annotation.isin(targets)]
-    #split the data by annotation.
-    growd = {}
-    for ann, osdf in rc.groupby("auto_annotation"):
-        #prep the data.
-        X_week = []
-        X_country_week_total = []
-        Y = []
-        #start with one annotation as a test.
-        for keys, sdf in osdf.groupby(['country']):
-            sdf = sdf.sort_values('date').reset_index()
-            #skip country/lineage pairs which don't have at least two weeks. Single weeks can only be used for initial proportion inference and are not generally useful.
-            if sdf.shape[0] >= 2:
-                for i,d in sdf.iterrows():
-                    X_week.append(i)
-                    X_country_week_total.append(d.country_count)
-                    Y.append(d['count'])
-        if len(Y) < min_data:
-            print(f"Skipping {ann} for insufficient data ({len(Y)} consecutive countryweeks).")
+        rc = rc[rc.auto_annotation.isin(list(targets))]
+    rc = rc.sort_values(['auto_annotation','country','week'])
+    groups = rc.groupby(['auto_annotation','country'], sort=False)
+    #skip country/lineage pairs which don't have at least two weeks. Single weeks can only be used for initial proportion inference and are not generally useful.
+    #the weeks each pair is seen are then numbered from 0.
+    rc = rc.assign(index=groups.cumcount().values, pairsize=groups['count'].transform('size').values)
+    rc = rc[rc.pairsize >= 2]
+    data = {}
+    for ann, osdf in rc.groupby("auto_annotation", sort=False):
+        if osdf.shape[0] < min_data:
+            print(f"Skipping {ann} for insufficient data ({osdf.shape[0]} consecutive countryweeks).")
             continue
+        data[ann] = (osdf['index'].values, osdf.country_count.values, osdf['count'].values)
+    return data
+
+def fit_growth(task):
+    """Fit the growth model of one annotation and return the 95% interval of its growth coefficient; run in the worker pool.
+    """
+    import pymc3 as pm
+    ann, (X_week, X_country_week_total, Y), target_accept, tune, draws, chains, cores = task
+    try:
+        with pm.Model() as model:
+            growth = pm.Normal(name='growth', sd=5)
+            initial_proportion = pm.TruncatedNormal(name='initial_proportion',upper=1,lower=0)
+            #cap the initial proportion value at 1 (100%) and log it for use. 
+            #This value will be informed for week 0 of a set of values. It should vary across countries, but not by too much.
+            log_initial_proportion = pm.Deterministic(name="log_initial_proportion",var=np.log(initial_proportion))
+            #estimate our expected proportion for this week, given our initial proportion and week. correct it back by exponentiation.
+            current_proportion = pm.Deterministic(name='base_proportion', var = np.e**(log_initial_proportion + growth * X_week))
+            #sampling process with our actual observed values.
+            y_obs = pm.Binomial(name='sampled', n=X_country_week_total, p=current_proportion, observed=Y)
+            #perform the actual inference process.
+            idata = pm.sample(draws=draws,tune=tune,chains=chains,cores=cores,progressbar=False,return_inferencedata=True,target_accept=target_accept)
+        return idata.posterior.growth.quantile(q=[0.025,0.975]).values
+    except pm.exceptions.SamplingError:
+        print(f"WARNING: Modeling failed for lineage {ann} due to initial model evaluation; check logs")
+    except Exception as e:
+        print(f"WARNING: Modeling failed for lineage {ann}: {e!r}")
+    return (np.nan,np.nan)
+
+def get_growth_laplace(data, growth_sd = 5, iterations = 100, tol = 1e-8):
+    """Fit a binomial GLM with a logit link to every annotation at once and return the 95% Laplace interval of each growth coefficient.
+
+    The model is the same as the sampled one, with the logit in place of the log of the proportion; the two agree
+    while the lineage is a small part of each country's samples, which maxperc ensures. The growth coefficient
+    keeps its normal prior, so the fit is the posterior mode and the interval comes from the curvature there.
+    Annotations whose fit does not converge get (nan, nan).
+
+    Args:
+        data (dict): Week indices, country totals and lineage counts by annotation, as from get_growth_data.
+        growth_sd (float): Standard deviation of the prior on the growth coefficient.
+    """
+    anns = list(data)
+    if len(anns) == 0:
+        return {}
+    #pad every annotation's data to the same length so all of them are fit together.
+    size = max(len(data[ann][2]) for ann in anns)
+    X = np.zeros((len(anns), size))
+    N = np.zeros((len(anns), size))
+    Y = np.zeros((len(anns), size))
+    for i, ann in enumerate(anns):
+        x, n, y = data[ann]
+        X[i,:len(y)] = x
+        N[i,:len(y)] = n
+        Y[i,:len(y)] = y
+    penalty = 1 / growth_sd**2
+    def objective(a, g):
+        eta = a[:,None] + g[:,None] * X
+        #log-likelihood up to a constant, written to stay finite for large |eta|.
+        return (Y * eta - N * np.logaddexp(0, eta)).sum(axis=1) - penalty * g**2 / 2
+    def curvature(a, g):
+        p = 1 / (1 + np.exp(-(a[:,None] + g[:,None] * X)))
+        w = N * p * (1 - p)
+        score = np.stack([(Y - N * p).sum(axis=1), ((Y - N * p) * X).sum(axis=1) - penalty * g], axis=1)
+        info = np.empty((len(anns), 2, 2))
+        info[:,0,0] = w.sum(axis=1)
+        info[:,0,1] = info[:,1,0] = (w * X).sum(axis=1)
+        info[:,1,1] = (w * X**2).sum(axis=1) + penalty
+        return score, info
+    #start from no growth at the overall proportion of each annotation.
+    a = np.log(Y.sum(axis=1) / (N.sum(axis=1) - Y.sum(axis=1)))
+    g = np.zeros(len(anns))
+    current = objective(a, g)
+    converged = np.zeros(len(anns), dtype=bool)
+    for _ in range(iterations):
+        score, info = curvature(a, g)
+        step = np.linalg.solve(info, score[:,:,None])[:,:,0]
+        #halve any Newton step that would lower the objective.
+        scale = np.ones(len(anns))
+        for _ in range(30):
+            proposed = objective(a + scale * step[:,0], g + scale * step[:,1])
+            worse = proposed < current - 1e-12
+            if not worse.any():
+                break
+            scale[worse] /= 2
+        a = a + scale * step[:,0]
+        g = g + scale * step[:,1]
+        current = objective(a, g)
+        converged = (np.abs(scale[:,None] * step) < tol).all(axis=1)
+        if converged.all():
+            break
+    _, info = curvature(a, g)
+    sd = np.sqrt(np.linalg.inv(info)[:,1,1])
+    growd = {}
+    for i, ann in enumerate(anns):
+        if converged[i] and np.isfinite(sd[i]):
+            growd[ann] = np.array([g[i] - 1.959963984540054 * sd[i], g[i] + 1.959963984540054 * sd[i]])
+        else:
+            print(f"WARNING: Growth estimate for lineage {ann} did not converge")
+            growd[ann] = (np.nan,np.nan)
+    return growd
+
+def get_growth_model(df, targets = [], min_data = 2, target_accept = 0.9, tune = 1500, draws = 1000, maxperc = .1, cores = None, chains = None, method = "mcmc", counts = None):
+    """Fit a growth model for each annotation with enough data and return the 95% interval of each growth coefficient.
+
+    Each fit samples its chains in parallel on up to cores processes, and the remaining budget is spent fitting
+    several annotations at once. A fit that fails gives (nan, nan) for its annotation without affecting the others.
+    With neither cores nor chains set, annotations are fit one at a time with PyMC3's own defaults for both.
+
+    Args:
+        cores (int): Total number of processes to use. Default PyMC3's, up to 4.
+        chains (int): Number of chains sampled per annotation. Default PyMC3's, as many as the cores of a fit but at least 2.
+        method (str): "mcmc" to sample each model with PyMC3, or "laplace" to fit all of them at once with get_growth_laplace.
+        counts (pd.DataFrame): Weekly counts of the samples in df, as from load_weekly_counts. Computed from df if not given.
+    """
+    if counts is None:
+        counts = get_weekly_counts(df)
+    data = get_growth_data(counts, targets, min_data, maxperc)
+    if method == "laplace":
+        print(f"Fitting growth estimates for {len(data)} annotations.")
+        return get_growth_laplace(data)
+    if cores == None:
+        chain_cores = None
+        workers = 1
+    else:
+        if chains == None:
+            #as many chains as PyMC3 runs by default on up to 4 cores; the rest of the budget goes to other lineages.
+            chains = max(2, min(cores, 4))
+        chain_cores = max(1, min(chains, cores))
+        workers = min(max(1, cores // chain_cores), len(data))
+    tasks = []
+    for ann, (X_week, X_country_week_total, Y) in data.items():
         print(f"Fitting model on annotation {ann} with {len(Y)} consecutive countryweeks of data.")
-        #fit the model!
+        tasks.append((ann, (X_week, X_country_week_total, Y), target_accept, tune, draws, chains, chain_cores))
+    growd = {}
+    if workers <= 1:
+        for task in tasks:
+            growd[task[0]] = fit_growth(task)
+        return growd
+    failed = []
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = [pool.submit(fit_growth, task) for task in tasks]
+        for task, future in zip(tasks, futures):
+            try:
+                growd[task[0]] = future.result()
+            except Exception:
+                failed.append(task)
+    #a worker that dies outright breaks the pool for every fit still pending, so those are retried one to a process.
+    for task in failed:
         try:
-            with pm.Model() as model:
-                growth = pm.Normal(name='growth', sd=5)
-                initial_proportion = pm.TruncatedNormal(name='initial_proportion',upper=1,lower=0)
-                #cap the initial proportion value at 1 (100%) and log it for use. 
-                #This value will be informed for week 0 of a set of values. It should vary across countries, but not by too much.
-                log_initial_proportion = pm.Deterministic(name="log_initial_proportion",var=np.log(initial_proportion))
-                #estimate our expected proportion for this week, given our initial proportion and week. correct it back by exponentiation.
-                current_proportion = pm.Deterministic(name='base_proportion', var = np.e**(log_initial_proportion + growth * X_week))
-                #sampling process with our actual observed values.
-                y_obs = pm.Binomial(name='sampled', n=X_country_week_total, p=current_proportion, observed=Y)
-                #perform the actual inference process.
-                idata = pm.sample(draws=draws,tune=tune,progressbar=False,return_inferencedata=True,target_accept=target_accept)
-            growd[ann] = idata.posterior.growth.quantile(q=[0.025,0.975]).values
-        except pymc3.exceptions.SamplingError:
-            print(f"WARNING: Modeling failed for lineage {ann} due to initial model evaluation; check logs")
-            growd[ann] = (np.nan,np.nan)
-    return growd
\ No newline at end of file
+            with ProcessPoolExecutor(max_workers=1) as pool:
+                growd[task[0]] = pool.submit(fit_growth, task).result()
+        except Exception as e:
+            print(f"WARNING: Modeling failed for lineage {task[0]}: {e!r}", file=sys.stderr)
+            growd[task[0]] = (np.nan,np.nan)
+    return {ann:growd[ann] for ann in data}
@@ -2,7 +2,8 @@ import sys
 sys.path.append("~/bin:")
 import argparse
 import pandas as pd
-import bte
+from tree_index import load_tree_index, PathWalker
+from designation_repo import LineageNotes, add_representatives
 import numpy as np
 import os
 import datetime as dt
@@ -26,10 +27,13 @@ def argparser():
     parser.add_argument("--automerge", action='store_true', help='Immediately merge this pull request if permissions allow.')
     parser.add_argument("-e", "--metadata", default=None,help="Path to a sample-level metadata file. Required for -M")
     parser.add_argument("-M", "--model_growth", action='store_true', help='Infer an estimate for the exponential growth coefficient for all lineage proposals which pass other filters and contain sufficient geospatial diversity for inference.')
+    parser.add_argument("--growth-method",choices=["mcmc","laplace","shortlist"],default="mcmc",help="Estimate growth by sampling a PyMC3 model for each lineage (mcmc), with a fast GLM fit of all lineages at once and Laplace approximate intervals (laplace), or with the fast fit for all lineages and sampling for the -m lineages it ranks highest (shortlist). Default mcmc")
     parser.add_argument("--draws",type=int,default=1000,help="Set the draws parameter for the Bayesian growth model.")
     parser.add_argument("--tune", type=int,default=1500,help="Set the tuning parameter for the sampler.")
     parser.add_argument("--min_country_weeks",type=int,default=5,help="Require at least this many valid data points for inference.")
     parser.add_argument("--target_accept",type=float,default=.8,help="Set the target acceptance parameter for the sampler.")
+    parser.add_argument("--chains",type=int,default=None,help="Set the number of chains sampled for each lineage's growth model. Default is PyMC3's.")
+    parser.add_argument("--cores",type=int,default=None,help="Number of processes used for growth modeling, shared between the chains of a model and models of different lineages. Default fits lineages one at a time with PyMC3's default cores.")
     parser.add_argument('--maxperc',type=float,default=.1,help="Ignore datapoints where the lineage proportion is greater than this proportion of samples. Use to ignore datapoints that are unlikely to follow an exponential curve, being close to a logistic inflection point.")
     parser.add_argument("--no-prefix",action='store_true',help="Use to remove the auto. prefix from generated lineages with respect to the files and pull request.")
     args = parser.parse_args()
@@ -72,15 +76,41 @@ def get_region_summary(row):
     assert type(cstr) == str
     return cstr
 
-def get_reps(nid, t, target = 5000, allowed = set()):
-    total = t.get_leaves_ids(nid)
-    if len(allowed) > 0:
-        #allow partial matching of names as well.
-        total = [l for l in total if l in allowed or l.split("|")[0] in allowed]
-    if len(total) <= target:
-        return total
-    else:
-        return list(np.random.choice(total, replace=False, size=target))
+def allowed_leaves(index, allowed):
+    """Return a boolean mask over node ordinals marking the leaves named in allowed, either in full or by the part of the name before the first "|".
+    """
+    leaves = index.get_leaves()
+    names = pd.Series([index.ids[l] for l in leaves])
+    #allow partial matching of names as well.
+    ok = names.isin(allowed) | names.str.split("|", n=1).str[0].isin(allowed)
+    mask = np.zeros(index.size, dtype=bool)
+    mask[leaves[ok.values]] = True
+    return mask
+
+def reservoir_sample(values, k):
+    """Return k of values chosen uniformly at random without replacement, skipping ahead between replacements (Li's algorithm L).
+    """
+    reservoir = list(values[:k])
+    if k == 0:
+        return reservoir
+    w = np.exp(np.log(np.random.random())/k)
+    i = k - 1
+    while True:
+        i += int(np.floor(np.log(np.random.random())/np.log(1-w))) + 1
+        if i >= len(values):
+            return reservoir
+        reservoir[np.random.randint(k)] = values[i]
+        w *= np.exp(np.log(np.random.random())/k)
+
+def get_reps(nid, index, target = 5000, allowed = None):
+    """Return the names of up to target leaves under nid, chosen at random, from those marked in the allowed mask if one is given.
+    """
+    total = index.get_leaves(index.ordinal(nid))
+    if allowed is not None:
+        total = total[allowed[total]]
+    if len(total) > target:
+        total = reservoir_sample(total, target)
+    return [index.ids[l] for l in total]
 
 def open_pr(branchname,trepo,automerge,reqname,pdf):
     g = Github(os.getenv("API_KEY"))
@@ -118,46 +148,43 @@ def write_note(row, no_prefix=False):
     return ''.join(outstr)
 
 def sort_notes(pdf, notecsv, no_prefix=False):
-    note_lookup = {}
+    notes = []
+    keys = {}
     for i,d in pdf.iterrows():
         note = write_note(d, no_prefix)
-        if d.parent not in note_lookup:
-            note_lookup[d.parent] = []
-        note_lookup[d.parent].append(note)
-    with open(notecsv) as inf:
-        with open(notecsv + ".updated",'w+') as outf:
-            for entry in notecsv:
-                lin = entry.strip().split('\t')[0]
-                print(entry.strip(),file=outf)
-                #if it has any new child lineages, add their notes after.
-                for clin in note_lookup.get(lin,[]):
-                    print(clin,file=outf)
-    os.rename(notecsv + ".updated", notecsv)
+        keys[d.proposed_sublineage] = note.split("\t")[0]
+        notes.append((keys[d.proposed_sublineage], d.parent, note))
+    #new lineages nested under other new lineages go after their parent's new note.
+    notes = [(lin, keys.get(parent, parent), note) for lin, parent, note in notes]
+    LineageNotes(notecsv).insert(notes)
     print(f"Updated lineages.txt and lineages.csv with {pdf.shape[0]} additional lineages.")
 
-def update_lineage_files(pdf, t, repo, rep, allowed, annotes, no_prefix=False):
+def update_lineage_files(pdf, index, repo, rep, allowed, annotes, no_prefix=False):
     lincsv = repo + "/lineages.csv"
     skip = set()
-    with open(lincsv, "a") as outf:
-        for i,row in pdf.iterrows():
-            sn = annotes.get(row.proposed_sublineage, None)
-            if sn == None:
-                print(f"WARNING: lineage {row.proposed_sublineage} not found on the input tree! Skipping")
-                skip.add(row.proposed_sublineage)
-                continue
-            rsamples = get_reps(sn, t, rep, allowed)
-            if len(rsamples) == 0:
-                print(f"WARNING: no representative samples found for lineage {row.proposed_sublineage}! Skipping",file=sys.stderr)
-                skip.add(row.proposed_sublineage)
-                continue
-            for rs in rsamples:
-                #only include the first part. not the ISL or the date.
-                rs_subset = rs.split("|")[0]
-                if no_prefix:
-                    psl = row.proposed_sublineage.lstrip("auto.")
-                else:
-                    psl = row.proposed_sublineage
-                print(rs_subset + "," + psl, file=outf)
+    rows = []
+    for i,row in pdf.iterrows():
+        sn = annotes.get(row.proposed_sublineage, None)
+        if sn == None:
+            print(f"WARNING: lineage {row.proposed_sublineage} not found on the input tree! Skipping")
+            skip.add(row.proposed_sublineage)
+            continue
+        rsamples = get_reps(sn, index, rep, allowed)
+        if len(rsamples) == 0:
+            print(f"WARNING: no representative samples found for lineage {row.proposed_sublineage}! Skipping",file=sys.stderr)
+            skip.add(row.proposed_sublineage)
+            continue
+        if no_prefix:
+            psl = row.proposed_sublineage.lstrip("auto.")
+        else:
+            psl = row.proposed_sublineage
+        for rs in rsamples:
+            #only include the first part. not the ISL or the date.
+            rows.append((rs.split("|")[0], psl))
+    #rows already in lineages.csv are not written again.
+    added = add_representatives(lincsv, rows)
+    if added < len(rows):
+        print(f"{len(rows) - added} representative samples were already listed in lineages.csv.",file=sys.stderr)
     print(f"{pdf.shape[0]-len(skip)} lineages added to lineages.csv; {len(skip)} skipped for having no high quality descendents.")
     notecsv = repo + "/lineage_notes.txt"
     pdf = pdf[~pdf.proposed_sublineage.isin(skip)]
@@ -177,16 +204,23 @@ def main():
     if args.active_since != None and args.active_since != "None":
         pdf = pdf[(pdf.latest_child.apply(get_date) >= dt.datetime.strptime(args.active_since,"%Y-%m-%d"))]
     if args.model_growth:
-        print(f"Modeling growth with PyMC3 for {pdf.shape[0]} lineages",file=sys.stderr)
-        from model_growth import get_growth_model
+        print(f"Modeling growth ({args.growth_method}) for {pdf.shape[0]} lineages",file=sys.stderr)
+        from model_growth import get_growth_model, load_weekly_counts
         if args.metadata == None:
             print("ERROR: -e must be set with -M output.")
             sys.exit(1)
-        mdf = pd.read_csv(args.metadata,sep='\t')
+        #the weekly counts are cached by metadata hash, so later runs on the same metadata skip loading it.
+        counts = load_weekly_counts(args.metadata)
         # mdf = mdf[mdf.auto_annotation.isin(pdf.proposed_sublineage)]
         # print(f"{mdf.shape[0]} samples to be used among {pdf.proposed_sublineage.nunique()} lineage models.")
-        mdf['date'] = mdf.date.apply(lambda x:get_date(x))
-        growd = get_growth_model(mdf, pdf.proposed_sublineage, args.min_country_weeks, args.target_accept, args.tune, args.draws, args.maxperc)
+        method = "laplace" if args.growth_method == "shortlist" else args.growth_method
+        growd = get_growth_model(None, pdf.proposed_sublineage, args.min_country_weeks, args.target_accept, args.tune, args.draws, args.maxperc, args.cores, args.chains, method, counts)
+        if args.growth_method == "shortlist":
+            #only the lineages that would make the report are sampled.
+            shortlist = sorted([k for k in growd if not np.isnan(growd[k][0])], key=lambda k:growd[k][0], reverse=True)[:args.maximum]
+            print(f"Sampling growth models for the {len(shortlist)} highest ranked lineages",file=sys.stderr)
+            if len(shortlist) > 0:
+                growd.update(get_growth_model(None, shortlist, args.min_country_weeks, args.target_accept, args.tune, args.draws, args.maxperc, args.cores, args.chains, counts=counts))
         pdf['Exponential Growth Coefficient CI'] = pdf.proposed_sublineage.apply(lambda x:growd.get(x,(np.nan,np.nan))) 
         pdf['Minimum Growth'] = pdf['Exponential Growth Coefficient CI'].apply(lambda x:x[0])
         pdf['Exponential Growth Coefficient CI'] = pdf['Exponential Growth Coefficient CI'].astype(str)
@@ -201,13 +235,11 @@ def main():
             for entry in inf:
                 allowed.add(entry.strip())
         print(f"{len(allowed)} total samples are available for updating lineages.csv",file=sys.stderr)
-    t = bte.MATree(args.tree)
-    try:
-        tannotes = t.dump_annotations()
-    except:
-        #newer versions of bte have a different function name.
-        tannotes = t.get_annotations()
-    pdf = update_lineage_files(pdf, t, args.repository, args.representative, allowed, tannotes, args.no_prefix)
+    index = load_tree_index(args.tree)
+    tannotes = index.dump_annotations()
+    #the allowed samples are matched against the leaves once, rather than per lineage.
+    allowed = allowed_leaves(index, allowed) if len(allowed) > 0 else None
+    pdf = update_lineage_files(pdf, index, args.repository, args.representative, allowed, tannotes, args.no_prefix)
     pdf['link'] = pdf.link.apply(lambda x:f"[View On Cov-Spectrum]({x})")
     def format_taxlink(txl):
         #skip trying to compress links that weren't generated.
@@ -231,9 +263,10 @@ def main():
             return f"[Get EPI ISLs]({epi_isls})"
     pdf['EPI ISLs'] = pdf.epi_isls.apply(make_epi_isl_table)
     pdf['Regions'] = pdf.apply(get_region_summary,axis=1)
+    walker = PathWalker(index)
     def get_mutation_set(row):
-        childhap = t.get_haplotype(row.proposed_sublineage_nid)
-        parenthap = t.get_haplotype(row.parent_nid)
+        childhap = walker.haplotype(index.ordinal(row.proposed_sublineage_nid))
+        parenthap = walker.haplotype(index.ordinal(row.parent_nid))
         return ",".join(list(childhap.difference(parenthap)))
     pdf['Nucleotide Changes'] = pdf.apply(get_mutation_set,axis=1)
     pdf['Lineage Name'] = pdf.proposed_sublineage.apply(compress_lineage)
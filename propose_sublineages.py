@@ -3,161 +3,220 @@ sys.path.append("~/bin:")
 import bte
 import sys
 import argparse
+import heapq
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+from tree_index import TreeIndex, Clade, load_tree_index, snapshot_dir, share_arrays, attach_arrays, process_mstr
+from translation import load_translation
 from pango_aliasor.aliasor import Aliasor
 global_aliasor = Aliasor()
 
-def process_mstr(mstr):
-    """Read a mutation string and return the chromosome, location, reference, and alternate alleles.
+def lookup_weights(keyed, keys):
+    """Look up integer keys in a list of (key, weight) pairs, returning 0 for keys not present.
     """
-    if ":" in mstr:
-        chro = mstr.split(":")[0]
-        data = mstr.split(":")[1]
-    else:
-        chro = None
-        data = mstr
-    if data[0].isdigit():
-        loc = int(data[:-1])
-        ref = None
-        alt = data[-1]
-    else:
-        loc = int(data[1:-1])
-        ref = data[0]
-        alt = data[-1]
-    return chro, loc, ref, alt
+    if len(keyed) == 0:
+        return np.zeros(len(keys))
+    keyed.sort()
+    known = np.array([k for k, _ in keyed], dtype=np.int64)
+    values = np.array([w for _, w in keyed], dtype=np.float64)
+    pos = np.minimum(np.searchsorted(known, keys), len(known) - 1)
+    return np.where(known[pos] == keys, values[pos], 0)
 
-def compute_mutation_weight(node,mutweights):
+def get_branch_weights(index, mutweights):
+    """Resolve the weight of every branch of the tree once, as an array indexed by node ordinal.
+
+    Each mutation counts as the larger of its general weight and any weight specific to the node it occurs on.
+    Mutations are matched against the parsed mutation table of the index, so no mutation string is read again.
+    """
     if len(mutweights) == 0:
         #if the mutweights parameter is not used, use the branch length attribute
         #in a standard MAT this is equal to len(node.mutations)
         #in alternative formats, it may be other float values.
-        if node.branch_length < 0:
-            print(f"WARNING: Negative branch length detected on node {node.id}! Treating as 0...")
-            return 0
-        return node.branch_length
-    dist = 0
-    for m in node.mutations:
-        _, loc, _, alt = process_mstr(m)
-        mweight = max([mutweights.get((loc,alt,None),0),mutweights.get((loc,alt,node.id),0)])
-        dist += mweight
-    return dist
-
-def dists_to_root(node, mutweights = {}):
-    #nodes must be a dict that gets updated on each recursion
-    #gives back a dict with all nodes and their respective dist from root
-    #initalize this with our starting node at 0, its our "root" whether its the actual tree root or not
-    nodes = {node.id:0}
-    def recursive_dists_to_roots(snode):
-        bweight = nodes[snode.id]
-        for child in snode.children:
-            dist = bweight + compute_mutation_weight(child, mutweights)  
-            nodes[child.id] = dist
-            recursive_dists_to_roots(child)
-    recursive_dists_to_roots(node)
-    return nodes
-
-def get_sum_and_count(rbfs, ignore = set(), mutweights = {}, sampleweights = {}):
-    # node sum stored in first index and node count stored in second index of each dict entry
-    sum_and_count_dict = {}
-    leaf_count = 0
-    for node in rbfs:
-        if node.is_leaf():
-            leaf_count += 1
-            if node.id not in ignore:
-                #some samples can count as more than one- or less than one- sample for computing weight values.
-                if len(sampleweights) == 0:
-                    count = 1
-                else:
-                    count = float(sampleweights.get(node.id, 0))
-                sum_and_count_dict[node.id] = (compute_mutation_weight(node,mutweights), count)
+        for o in np.nonzero(index.branch_length < 0)[0]:
+            print(f"WARNING: Negative branch length detected on node {index.ids[o]}! Treating as 0...")
+        return np.where(index.branch_length < 0, 0, index.branch_length)
+    #mutations are keyed by location and alternate allele, and node-specific weights additionally by node ordinal.
+    span = max(int(index.mut_loc.max(initial=0)), max(k[0] for k in mutweights)) + 1
+    nodes = index.mutation_nodes()
+    keys = index.mut_loc.astype(np.int64) * 256 + index.mut_alt
+    general = []
+    specific = []
+    for (loc, alt, nid), w in mutweights.items():
+        if nid == None:
+            general.append((loc * 256 + ord(alt), w))
+        elif nid in index.index:
+            specific.append((index.index[nid] * span * 256 + loc * 256 + ord(alt), w))
+    mweights = np.maximum(lookup_weights(general, keys), lookup_weights(specific, nodes * span * 256 + keys))
+    #bincount adds each node's mutations in order.
+    return np.bincount(nodes, weights=mweights, minlength=index.size)
+
+def dists_to_root(clade, weights):
+    #gives back an array with the dist of every clade position from the clade root
+    #the clade root is at 0, its our "root" whether its the actual tree root or not
+    #weights holds the branch weight of each clade position; each level is finished before its children are visited.
+    dists = np.zeros(clade.size)
+    for level in clade.levels[1:]:
+        dists[level] = dists[clade.parent[level]] + weights[level]
+    return dists
+
+def get_sum_and_count(clade, weights, ignore, counts):
+    # node sums and counts are stored in parallel arrays over the clade positions. Nodes without any counted descendents are left at 0.
+    # ignore marks leaves that should not be counted, counts holds the sample weight of each leaf.
+    sums = np.zeros(clade.size)
+    totals = np.zeros(clade.size)
+    has_entry = clade.is_leaf & ~ignore
+    for d in range(len(clade.levels)-1, -1, -1):
+        level = clade.levels[d]
+        leaves = level[clade.is_leaf[level]]
+        #some samples can count as more than one- or less than one- sample for computing weight values.
+        sums[leaves] = np.where(has_entry[leaves], weights[leaves], 0)
+        totals[leaves] = np.where(has_entry[leaves], counts[leaves], 0)
+        #internal nodes already hold the totals of their children, pushed up from the level below.
+        internal = level[~clade.is_leaf[level]]
+        counted = totals[internal] > 0
+        has_entry[internal] = counted
+        #total path length is computed as the total path lengths to each child plus the length of the current node TIMES the number of samples.
+        #this is because total path length is not the same as tree parsimony- some mutations are part of many sample paths
+        #for a given sample to its parent, the total path length is just the number of mutations (as computed above)
+        #but for an internal node with two leaf children's path length with respect to its parent, 
+        #its equal to the sum of the two child's path lengths plus 2 times its mutations, since those mutations are shared among 2 samples
+        #this logic applies as we move further up the tree.
+        sums[internal] = np.where(counted, sums[internal] + weights[internal] * totals[internal], 0)
+        totals[internal] = np.where(counted, totals[internal], 0)
+        if d > 0:
+            #np.add.at accumulates in order, so siblings are summed in the same order as a node-by-node pass.
+            pushed = level[has_entry[level]]
+            np.add.at(sums, clade.parent[pushed], sums[pushed])
+            np.add.at(totals, clade.parent[pushed], totals[pushed])
+    return sums, totals, int(clade.is_leaf.sum())
+
+def remove_descendents(index, clade, weights, sums, counts, b):
+    """Update the output of get_sum_and_count in place after every sample descended from clade position b is labeled.
+
+    Only b and its ancestors change. Each ancestor is re-totaled from its children, in the same order as the full pass,
+    so the updated values are identical to recomputing the whole clade.
+    """
+    start = index.first[clade.lo + b] - clade.lo
+    sums[start:b+1] = 0
+    counts[start:b+1] = 0
+    p = clade.parent[b]
+    while p >= 0:
+        children = index.get_children(clade.lo + p) - clade.lo
+        total_count = np.cumsum(counts[children])[-1]
+        if total_count > 0:
+            sums[p] = np.cumsum(sums[children])[-1] + weights[p] * total_count
+            counts[p] = total_count
         else:
-            total_count = 0
-            total_sum = 0
-            for child in node.children:
-                sumtc = sum_and_count_dict.get(child.id, None)
-                if sumtc == None:
-                    continue
-                total_count += sumtc[1]
-                total_sum += sumtc[0]
-            if total_count > 0:
-                #total path length is computed as the total path lengths to each child plus the length of the current node TIMES the number of samples.
-                #this is because total path length is not the same as tree parsimony- some mutations are part of many sample paths
-                #for a given sample to its parent, the total path length is just the number of mutations (as computed above)
-                #but for an internal node with two leaf children's path length with respect to its parent, 
-                #its equal to the sum of the two child's path lengths plus 2 times its mutations, since those mutations are shared among 2 samples
-                #this logic applies as we move further up the tree.
-                sum_and_count_dict[node.id] = (total_sum + compute_mutation_weight(node,mutweights) * total_count, total_count)
-    return sum_and_count_dict, leaf_count #, leaves
-
-def evaluate_candidate(a, nid, sum_and_counts, dist_to_root, minimum_size=0,minimum_distinction=0):
-    """Evaluate a candidate branch as a putative sublineage.
+            sums[p] = 0
+            counts[p] = 0
+        p = clade.parent[p]
+
+def evaluate_candidates(sums, counts, candidate_to_parent, minimum_size=0, minimum_distinction=0):
+    """Evaluate branches of a clade as putative sublineages.
 
     Args:
-        t (MATree): The tree.   
-        a (str): The parent lineage annotation node.
-        nid (str): The node id of the candidate branch.
+        sums (np.ndarray): Total path length to counted descendents of each candidate.
+        counts (np.ndarray): Total sample weight descended from each candidate.
+        candidate_to_parent (np.ndarray): Distance of each candidate from the parent lineage annotation node.
     """
-    node_sum, node_count = sum_and_counts.get(nid,[0,0])
-    if node_count <= minimum_size:
-        return 0
-    if node_sum == 0 or node_count <= 0:
-        return 0
-    candidate_to_parent = dist_to_root[nid] - dist_to_root[a]
-    if candidate_to_parent < minimum_distinction:
-        return 0
-    mean_distances = node_sum/node_count
-    if (mean_distances + candidate_to_parent) == 0:   #avoid divide by 0
-        candidate_value = 0
-    else:
-        # print("DEBUG: {} {} {} {}".format(node_count, max([(node_count-minimum_size+1),0]), candidate_to_parent, max([candidate_to_parent-minimum_distinction+1,0])))
-        # candidate_value = max([(node_count-minimum_size+1),0]) * (max([candidate_to_parent-minimum_distinction+1,0])) / (mean_distances + candidate_to_parent)
-        candidate_value = node_count * candidate_to_parent / (mean_distances + candidate_to_parent)
-    return candidate_value
+    with np.errstate(divide='ignore', invalid='ignore'):
+        mean_distances = sums/counts
+        denominator = mean_distances + candidate_to_parent
+        candidate_values = counts * candidate_to_parent / denominator
+    #avoid divide by 0, and zero out any candidate that is too small or too close to the parent.
+    valid = (counts > minimum_size) & (sums != 0) & (counts > 0) & (candidate_to_parent >= minimum_distinction) & (denominator != 0)
+    return np.where(valid, candidate_values, 0)
 
-def evaluate_lineage(t, dist_to_root, anid, candidates, sum_and_count, minimum_size = 0, minimum_distinction = 0, banned = set()):
-    """Evaluate every descendent branch of lineage a to propose new sublineages.
+def evaluate_lineage(clade, dists, sums, counts, minimum_size = 0, minimum_distinction = 0, banned = None):
+    """Evaluate every descendent branch of a clade root to propose new sublineages.
 
     Args:
-        t (MATree): The tree.
-        a (str): The lineage annotation node to check.
+        clade (Clade): The clade of the lineage annotation node to check.
+        banned (np.ndarray): Boolean mask of clade positions which may not be proposed.
+
+    Returns the best score and its clade position, or (0, None) if no candidate scores above 0.
     """
-    good_candidates = []
-    for c in candidates:
-        if not c.is_leaf() and c.id not in banned:
-            cscore = evaluate_candidate(anid, c.id, sum_and_count, dist_to_root, minimum_size,minimum_distinction)
-            if cscore > 0:
-                good_candidates.append((cscore,c))
-    if len(good_candidates) == 0:
+    scores = evaluate_candidates(sums, counts, dists - dists[clade.root], minimum_size, minimum_distinction)
+    scores[clade.is_leaf] = 0
+    if banned is not None:
+        scores[banned] = 0
+    #candidates are ranked in reverse breadth-first order, with ties going to the first seen.
+    order = clade.bfs[::-1]
+    best = order[np.argmax(scores[order])]
+    if scores[best] <= 0:
         return (0,None)
-    return max(good_candidates, key=lambda x: x[0])
+    return (float(scores[best]), int(best))
+
+class CandidateHeap:
+    """Lazy-greedy max-heap over the candidate branches of one clade, replacing a full rescan for each serial lineage.
 
-def get_skipset(t, annotes):
+    Entries are revalidated against the current sums and counts when they reach the top of the heap. A score never exceeds
+    the weighted count of its node, and counts only shrink down the tree, so subtrees with a count at or below the minimum
+    size or the score floor are never entered. Ties resolve in the same reverse breadth-first order as evaluate_lineage.
     """
-    Return the set of nodes which are, or are ancestral to, existing lineages on the tree. 
+    def __init__(self, clade, dists, sums, counts, minimum_size = 0, minimum_distinction = 0, floor = 0, banned = None):
+        self.root = clade.root
+        self.minimum_size = minimum_size
+        self.minimum_distinction = minimum_distinction
+        self.floor = max(floor, 0)
+        self.bound = max(minimum_size, floor)
+        self.rank = np.empty(clade.size, dtype=np.int64)
+        self.rank[clade.bfs[::-1]] = np.arange(clade.size)
+        eligible = ~clade.is_leaf & (counts > self.bound)
+        if banned is not None:
+            eligible &= ~banned
+        candidates = np.nonzero(eligible)[0]
+        scores = evaluate_candidates(sums[candidates], counts[candidates], dists[candidates] - dists[self.root], minimum_size, minimum_distinction)
+        keep = scores > self.floor
+        self.heap = list(zip((-scores[keep]).tolist(), self.rank[candidates[keep]].tolist(), candidates[keep].tolist()))
+        heapq.heapify(self.heap)
+
+    def score(self, i, dists, sums, counts):
+        return float(evaluate_candidates(sums[i:i+1], counts[i:i+1], dists[i:i+1] - dists[self.root], self.minimum_size, self.minimum_distinction)[0])
+
+    def pop(self, dists, sums, counts, banned):
+        """Return the best current score and its clade position, or (0, None) if nothing scores above the floor.
+        """
+        while len(self.heap) > 0:
+            negscore, rank, i = self.heap[0]
+            if banned[i] or counts[i] <= self.bound:
+                #the node was used by an earlier lineage or lost its samples to one.
+                heapq.heappop(self.heap)
+                continue
+            current = self.score(i, dists, sums, counts)
+            if current != -negscore:
+                #stale entry; requeue it with its current score.
+                if current > self.floor:
+                    heapq.heapreplace(self.heap, (-current, rank, i))
+                else:
+                    heapq.heappop(self.heap)
+                continue
+            heapq.heappop(self.heap)
+            return (current, i)
+        return (0, None)
+
+def get_skipset(index, annotes):
+    """
+    Return a boolean mask of nodes which are, or are ancestral to, existing lineages on the tree. 
     Used to build a banned node list to prevent retroactive definition of lineage parents. 
     """
-    skip = set()
-    for lin, nid in annotes.items():
-        ancestors = t.rsearch(nid, True)
-        for anc in ancestors:
-            skip.add(anc.id)
-    return skip
-
-def get_outer_annotes(t, annotes):
+    return index.ancestor_mask([index.ordinal(nid) for nid in annotes.values()])
+
+def get_outer_annotes(index, annotes):
     """Get all outer annotations (annotations which are terminal for at least one sample) in a tree.
 
     Args:
-        t (MATree): The tree.
+        index (TreeIndex): The tree index.
         annotes (dict): The annotation dictionary.
     """
+    #the inherited annotations of every leaf, in leaf order; keep annotations in the order they first appear.
+    codes = index.inherited_annotations()[index.get_leaves()].ravel()
+    present, first_seen = np.unique(codes, return_index=True)
     outer_annotes = {}
-    for l in t.get_leaves():
-        mann = l.most_recent_annotation()
-        for a in mann:
-            if a != None and a not in outer_annotes and a in annotes:
-                outer_annotes[a] = annotes[a]
-        if len(outer_annotes) == len(annotes):
-            #all of them will be checked. No need to continue.
-            break
+    for c in present[np.argsort(first_seen)]:
+        if c >= 0 and index.annotation_names[c] in annotes:
+            a = index.annotation_names[c]
+            outer_annotes[a] = annotes[a]
     return outer_annotes
 
 def parse_mutweights(mutweights_file):
@@ -183,13 +242,13 @@ def parse_mutweights(mutweights_file):
         exit(1)
     return mutweights
 
-def build_annotation_network(t, rawann):
+def build_annotation_network(index, rawann):
     #build a dictionary reflecting the relationship structure between these nodes
     annd = {}
     for ann, nid in rawann.items():
-        pnode = t.get_node(nid).parent
-        if pnode != None: 
-            parents = pnode.most_recent_annotation()
+        p = index.parent[index.ordinal(nid)]
+        if p >= 0:
+            parents = index.most_recent_annotation(p)
         else:
             parents = []
         for p in parents:
@@ -210,14 +269,10 @@ def read_samples_weights(sfile):
                 samples[spent[0]] = spent[1]
     return samples
 
-def filter_annotes(t, annotes, selection):
-    filtered = {}
-    for ann, nid in annotes.items():
-        ancestry = t.rsearch(nid,True)
-        for a in ancestry:
-            if selection in a.annotations:
-                filtered[ann] = nid
-    return filtered
+def filter_annotes(index, annotes, selection):
+    #keep annotations at or below any node carrying the selected annotation.
+    selected = index.descendant_mask(index.annotated_with(selection))
+    return {ann:nid for ann, nid in annotes.items() if selected[index.ordinal(nid)]}
 
 def parse_aaweights(aaf):
     aad = {}
@@ -229,6 +284,102 @@ def parse_aaweights(aaf):
             aad[(gene, site, state)] = float(weight)
     return aad
 
+def make_search_state(arrays, params, index = None):
+    """Collect the arrays and parameters used by search_lineage. Prefix counts of unlabeled leaves are derived here.
+    """
+    state = dict(arrays)
+    state.update(params)
+    if index == None:
+        index = TreeIndex.from_topology(arrays)
+    state['index'] = index
+    state['labeled_count'] = int(arrays['labeled'].sum())
+    state['free_before'] = np.concatenate([[0], np.cumsum(index.is_leaf & ~arrays['labeled'])])
+    return state
+
+def search_lineage(state, root, child_roots):
+    """Propose serial sublineages within the clade of a single lineage.
+
+    Args:
+        state (dict): Shared arrays and parameters from make_search_state.
+        root (int): Ordinal of the lineage annotation node.
+        child_roots (list): Ordinals of preexisting child lineages, whose samples are considered labeled.
+
+    Returns 'empty' if no samples descended from the lineage have weight. Otherwise returns the number of samples prelabeled
+    by child lineages, the weighted sample count of the clade, a list of (score, node ordinal, leaf count) proposals,
+    and whether the search stopped because the coverage cutoff was reached.
+    """
+    index = state['index']
+    clade = Clade(index, root)
+    lo, hi = clade.lo, clade.hi
+    parent_leaf_count = int(state['weighted'][lo:hi].sum())
+    if parent_leaf_count == 0:
+        return 'empty'
+    #private overlays of the shared labeled and used masks covering only this clade; the shared masks are never written here.
+    ignore = state['labeled'][lo:hi].copy()
+    banned = state['used'][lo:hi].copy()
+    picked = state['picked'][lo:hi]
+    if picked.any():
+        #nodes at or above a lineage proposed earlier in this level are used as well.
+        marked = np.concatenate([[0], np.cumsum(picked)])
+        banned |= marked[1:] - marked[index.first[lo:hi] - lo] > 0
+    #labeled samples outside the clade only matter for the total count.
+    outside = state['labeled_count'] - int(ignore[clade.is_leaf].sum())
+    free_before = state['free_before']
+    covered = -1
+    for start in sorted(set(index.first[c] for c in child_roots)):
+        #child lineage clades are nested or disjoint; only count each outermost one.
+        end = max(c for c in child_roots if index.first[c] == start)
+        if end <= covered:
+            continue
+        covered = end
+        ignore[max(start, lo) - lo:max(min(end + 1, hi) - lo, 0)] = True
+        if start < lo:
+            outside += free_before[min(end + 1, lo)] - free_before[start]
+        if end >= hi:
+            outside += free_before[end + 1] - free_before[max(start, hi)]
+    labeled_count = int(outside) + int(ignore[clade.is_leaf].sum())
+    prelabeled = labeled_count - state['labeled_count']
+    cweights = state['weights'][lo:hi]
+    ccounts = state['sample_counts'][lo:hi]
+    dist_root = dists_to_root(clade, cweights)
+    #the full pass is only needed once; each accepted sublineage then only changes its own ancestors.
+    sums, counts, leaf_count = get_sum_and_count(clade, cweights, ignore, ccounts)
+    if state['selection'] == 'heap':
+        candidates = CandidateHeap(clade, dist_root, sums, counts, state['minsamples'], state['distinction'], state['floor'], banned)
+    proposals = []
+    at_cutoff = False
+    while True:
+        if state['selection'] == 'heap':
+            best_score, best = candidates.pop(dist_root, sums, counts, banned)
+        else:
+            best_score, best = evaluate_lineage(clade, dist_root, sums, counts, state['minsamples'], state['distinction'], banned)
+        if best_score <= state['floor']:
+            break
+        for anc in clade.ancestors(best):
+            banned[anc] = True
+        start = index.first[lo + best] - lo
+        leaves = clade.is_leaf[start:best + 1]
+        labeled_count += int((leaves & ~ignore[start:best + 1]).sum())
+        ignore[start:best + 1] = True
+        remove_descendents(index, clade, cweights, sums, counts, best)
+        proposals.append((best_score, lo + best, int(leaves.sum())))
+        if labeled_count >= leaf_count * state['cutoff']:
+            at_cutoff = True
+            break
+    return prelabeled, parent_leaf_count, proposals, at_cutoff
+
+_worker_state = {}
+
+def init_worker(spec, params):
+    arrays, blocks = attach_arrays(spec)
+    _worker_state.update(make_search_state(arrays, params))
+    #keep the shared memory blocks referenced for the life of the worker.
+    _worker_state['blocks'] = blocks
+
+def search_lineage_worker(task):
+    root, child_roots = task
+    return search_lineage(_worker_state, root, child_roots)
+
 def argparser():
     parser = argparse.ArgumentParser(description="Propose sublineages for existing lineages based on relative representation concept.")
     parser.add_argument("-i", "--input", required=True, help='Path to protobuf to annotate.')
@@ -249,11 +400,21 @@ def argparser():
     parser.add_argument("--reference", help='Path to a reference fasta file to apply translation. Use with --gtf.')
     parser.add_argument("-v","--verbose",help='Print status updates.',action='store_true')
     parser.add_argument("-a","--annotation",help='Choose a specific lineage, and its sublineages, to propose new sublineages for.',default=None)
+    parser.add_argument("--selection",help='Method for finding the best candidate for each serial lineage. "scan" rescores every candidate each time; "heap" keeps a lazily revalidated max-heap and gives identical proposals. Default scan',choices=['scan','heap'],default='scan')
+    parser.add_argument("-j","--threads","--processes",help='Number of worker processes used to search the lineages of each level in parallel. Default 1',type=int,default=1)
     parser.add_argument("-p","--samples",help='Path to a space-delimited file containing samples and weights in the first and second columns. If used, samples not included in this file will be ignored.',default=None)
     return parser
 
 def propose(args):
     t = bte.MATree(args.input)
+    if args.clear:
+        t.apply_node_annotations({node.id:[] for node in t.depth_first_expansion()})
+    if args.verbose:
+        print("Indexing tree.")
+    if args.clear:
+        index = TreeIndex(t)
+    else:
+        index = load_tree_index(args.input, t)
     mutweights = {}
     if args.gene == 'ORF1a' or args.gene == 'ORF1b':
         print("WARNING: ORF1a and ORF1b are treated as a unified ORF1ab for purposes of haplotype identification due to complexities with redundant counting and translation implementation.")
@@ -265,7 +426,11 @@ def propose(args):
         if args.aaweights != None:
             print("Retrieving amino acid change weightings.")
             aaweights = parse_aaweights(args.aaweights)
-        translation = t.translate(fasta_file=args.reference,gtf_file=args.gtf)
+        nodes = None
+        if args.annotation != None:
+            #only lineages below the selected one are searched, so only their clades need translating.
+            nodes = index.descendant_mask(index.annotated_with(args.annotation))
+        translation = load_translation(index, args.reference, args.gtf, snapshot_dir(args.input), nodes)
         for nid, aav in translation.items():
             for aa in aav:
                 if args.missense and aa.is_synonymous():
@@ -281,8 +446,6 @@ def propose(args):
         print("Considering {} mutations to have weight.".format(len(mutweights)))
     if args.dump != None:
         dumpf = open(args.dump,'w+')
-    if args.clear:
-        t.apply_node_annotations({node.id:[] for node in t.depth_first_expansion()})
     try:
         cannotes = t.dump_annotations()
     except:
@@ -298,14 +461,14 @@ def propose(args):
         #only keep annotations that have the indicated annotation on their ancestry path.
         if args.verbose:
             print("Finding annotations that are descendants of {}.".format(args.annotation))
-        annotes = filter_annotes(t, annotes, args.annotation)
+        annotes = filter_annotes(index, annotes, args.annotation)
         if args.verbose:
             print("Found {} annotations to check for sublineages.".format(len(annotes)))
     if args.clear:
         assert len(annotes) == 0
-    ann_net = build_annotation_network(t, annotes)
+    ann_net = build_annotation_network(index, annotes)
     original_annotations = set(annotes.keys())
-    global_used_nodes = get_skipset(t, annotes)
+    global_used_nodes = get_skipset(index, annotes)
     if len(annotes) == 0:
         if args.verbose and not args.clear:
             print("No lineages found in tree; starting from root.")
@@ -313,88 +476,105 @@ def propose(args):
     else:
         if args.verbose:
             print("{} annotations found in the tree; identifying candidates for subdivision.".format(len(annotes)))
-        annotes = get_outer_annotes(t, annotes)
+        annotes = get_outer_annotes(index, annotes)
         if args.verbose:
             print("{} outer annotations found in the tree; identifying sublineages.".format(len(annotes)))
     if args.verbose:
-        print("Tree contains {} annotated lineages initially ({} nodes disregarded to prevent retroactive parent assignment).".format(len(annotes),len(global_used_nodes)))
+        print("Tree contains {} annotated lineages initially ({} nodes disregarded to prevent retroactive parent assignment).".format(len(annotes),int(global_used_nodes.sum())))
     #keep going until the length of the annotation dictionary doesn't change.
     if args.dump != None:
         print("parent\tparent_nid\tproposed_sublineage\tproposed_sublineage_nid\tproposed_sublineage_score\tproposed_sublineage_size",file=dumpf)
     outer_annotes = annotes
-    global_labeled = set()
     sample_weights = {}
     if args.samples != None:
-        allsamples = t.get_leaves_ids()
         sample_weights = read_samples_weights(args.samples)
-        for s in allsamples:
-            if s not in sample_weights:
-                global_labeled.add(s)
-        if args.verbose:
-            print("{} samples given weights; ignoring {} samples".format(len(sample_weights),len(global_labeled)))
+    #everything the serial search needs, as arrays indexed by node ordinal; worker processes attach to these through shared memory.
+    #sample sets are kept as boolean masks over the ordinals, so their size is fixed by the tree however many lineages are searched.
+    arrays = index.topology()
+    arrays['weights'] = get_branch_weights(index, mutweights)
+    if len(sample_weights) == 0:
+        arrays['sample_counts'] = np.ones(index.size)
+        arrays['weighted'] = index.is_leaf
+    else:
+        arrays['sample_counts'] = np.array([float(sample_weights.get(nid, 0)) for nid in index.ids])
+        arrays['weighted'] = np.array([nid in sample_weights for nid in index.ids])
+    #samples without a weight are treated as labeled from the start.
+    arrays['labeled'] = index.is_leaf & ~arrays['weighted']
+    if args.verbose and len(sample_weights) > 0:
+        print("{} samples given weights; ignoring {} samples".format(len(sample_weights),int(arrays['labeled'].sum())))
+    arrays['used'] = global_used_nodes
+    #lineage roots proposed so far in the current level; their ancestors are also used.
+    arrays['picked'] = np.zeros(index.size, dtype=bool)
+    params = {'minsamples':args.minsamples, 'distinction':args.distinction, 'floor':args.floor, 'cutoff':args.cutoff, 'selection':args.selection}
+    pool = None
+    blocks = []
+    if args.threads > 1:
+        arrays, blocks, spec = share_arrays(arrays)
+        pool = ProcessPoolExecutor(max_workers=args.threads, initializer=init_worker, initargs=(spec, params))
+    state = make_search_state(arrays, params, index)
     level = 1
-    while True:
-        if args.verbose:
-            print("Level: ",level)
-        new_annotes = {}
-        used_nodes = global_used_nodes.copy()
-        for ann,nid in outer_annotes.items():
-            serial = 1
-            rbfs = t.breadth_first_expansion(nid, True) #takes the name
-            if len(sample_weights) == 0:
-                parent_leaf_count = len([n for n in rbfs if n.is_leaf()])
+    try:
+        while True:
+            if args.verbose:
+                print("Level: ",level)
+            new_annotes = {}
+            state['picked'][:] = False
+            tasks = []
+            for ann,nid in outer_annotes.items():
+                child_roots = [index.ordinal(v) for k,v in annotes.items() if ann in ann_net.get(k,[])]
+                tasks.append((ann, nid, index.ordinal(nid), child_roots))
+            if pool != None:
+                #every worker sees the used nodes from the start of the level. Results are merged in order below.
+                results = list(pool.map(search_lineage_worker, [(root, child_roots) for _, _, root, child_roots in tasks], chunksize=max(1, len(tasks)//(4*args.threads))))
             else:
-                parent_leaf_count = len([n for n in rbfs if n.id in sample_weights])
-            if parent_leaf_count == 0:
-                if args.verbose:
-                    print("No samples descended from {} have weight; continuing".format(ann))
-                continue
-            current_child_lineages = {k:v for k,v in annotes.items() if ann in ann_net.get(k,[])}
-            labeled = global_labeled.copy()
-            for lin, cnid in current_child_lineages.items():
-                for s in t.get_leaves_ids(cnid):
-                    labeled.add(s)
-            if len(current_child_lineages) > 0 and args.verbose:
-                print("Found {} child lineages preexisting for lineage {}; {} samples prelabeled from {} total ({}%)".format(len(current_child_lineages), ann, len(labeled)-len(global_labeled), parent_leaf_count, 100*(len(labeled)-len(global_labeled))/parent_leaf_count))
-            # print("DEBUG: Checking annotation {} with {} descendent nodes.".format(nid, len(rbfs)))
-            dist_root = dists_to_root(t.get_node(nid), mutweights) #needs the node object, not just the name
-            while True:
-                scdict, leaf_count = get_sum_and_count(rbfs, ignore = labeled, mutweights = mutweights, sampleweights = sample_weights)
-                # print("DEBUG: total distances to root {}, total sums {}".format(sum(dist_root.values()),sum([v[0] for v in scdict.values()])))
-                best_score, best_node = evaluate_lineage(t, dist_root, nid, rbfs, scdict, args.minsamples, args.distinction, used_nodes)
-                if best_score <= args.floor:
-                    # print("DEBUG: Best doesn't pass threshold with score {} out of {}".format(best_score, args.floor))
-                    break
-                if ann[:5] == 'auto.':
-                    prefix = ann
-                else:
-                    prefix = "auto." + ann
-                newname = prefix + "." + str(serial)
-                while newname in original_annotations or newname.lstrip("auto.") in original_annotations:
+                results = [None] * len(tasks)
+            for (ann, nid, root, child_roots), result in zip(tasks, results):
+                if result == None or state['picked'][index.first[root]:root+1].any():
+                    #run serially against the used nodes so far, either because there is no pool
+                    #or because an earlier lineage of this level proposed inside this clade.
+                    result = search_lineage(state, root, child_roots)
+                if result == 'empty':
+                    if args.verbose:
+                        print("No samples descended from {} have weight; continuing".format(ann))
+                    continue
+                prelabeled, parent_leaf_count, proposals, at_cutoff = result
+                if len(child_roots) > 0 and args.verbose:
+                    print("Found {} child lineages preexisting for lineage {}; {} samples prelabeled from {} total ({}%)".format(len(child_roots), ann, prelabeled, parent_leaf_count, 100*prelabeled/parent_leaf_count))
+                serial = 1
+                for i, (best_score, best, nleaves) in enumerate(proposals):
+                    if ann[:5] == 'auto.':
+                        prefix = ann
+                    else:
+                        prefix = "auto." + ann
+                    newname = prefix + "." + str(serial)
+                    while newname in original_annotations or newname.lstrip("auto.") in original_annotations:
+                        serial += 1
+                        newname = prefix + '.' + str(serial)
+                    state['picked'][best] = True
+                    best_id = index.ids[best]
+                    new_annotes[newname] = best_id
+                    if args.dump != None:
+                        print("{}\t{}\t{}\t{}\t{}\t{}".format(ann,nid,newname,best_id,str(best_score),nleaves),file=dumpf)
+                    if at_cutoff and i == len(proposals) - 1:
+                        break
                     serial += 1
-                    newname = prefix + '.' + str(serial)
-                for anc in t.rsearch(best_node.id,True):
-                    used_nodes.add(anc.id)
-                new_annotes[newname] = best_node.id
-                leaves = t.get_leaves_ids(best_node.id)
-                if args.dump != None:
-                    print("{}\t{}\t{}\t{}\t{}\t{}".format(ann,nid,newname,best_node.id,str(best_score),len(leaves)),file=dumpf)
-                for l in leaves:
-                    labeled.add(l)
-                if len(labeled) >= leaf_count * args.cutoff:
-                    break
-                serial += 1
-                if args.verbose:
-                    print("Annotated lineage {} as descendent of {} from level {} with {} descendents".format(newname, ann, level, len(leaves)))
-        if not args.recursive:
-            annotes.update(new_annotes)
-            break
-        elif len(new_annotes) == 0:
-            break
-        else:
-            annotes.update(new_annotes)
-            outer_annotes = new_annotes
-            level += 1
+                    if args.verbose:
+                        print("Annotated lineage {} as descendent of {} from level {} with {} descendents".format(newname, ann, level, nleaves))
+            if not args.recursive:
+                annotes.update(new_annotes)
+                break
+            elif len(new_annotes) == 0:
+                break
+            else:
+                annotes.update(new_annotes)
+                outer_annotes = new_annotes
+                level += 1
+    finally:
+        if pool != None:
+            pool.shutdown()
+        for shm in blocks:
+            shm.close()
+            shm.unlink()
     if args.verbose:
         print("After sublineage annotation, tree contains {} annotated lineages.".format(len(annotes)),file=sys.stderr)
     if args.output != None:
@@ -414,6 +594,8 @@ def propose(args):
         # print(f"DEBUG: final size of annotation dict {len(annd)}")
         t.apply_node_annotations(annd)
         t.save_pb(args.output)
+        #snapshot the annotated tree so that the downstream scripts can map it instead of parsing it again.
+        load_tree_index(args.output, t)
     if args.dump != None:
         dumpf.close()
     if args.labels != None:
@@ -424,7 +606,7 @@ def propose(args):
             except:
                 # print(f"Could not compress lineage {ann}")
                 pass
-            for leaf in t.get_leaves_ids(nid):
+            for leaf in index.get_leaves_ids(index.ordinal(nid)):
                 if leaf not in labels:
                     labels[leaf] = [ann]
                 else:
@@ -0,0 +1,312 @@
+import os
+import hashlib
+import numpy as np
+from tree_index import file_hash, snapshot_dir, record_snapshot
+
+BASES = "TCAG"
+AMINO_ACIDS = "FFLLSSSSYY**CC*WLLLLPPPPHHQQRRRRIIIMTTTTNNKKSSRRVVVVAAAADDEEGGGG"
+
+def read_reference(fasta_file):
+    """Read the first record of a fasta file as an array of uppercase character codes.
+    """
+    seq = []
+    with open(fasta_file) as inf:
+        for line in inf:
+            if line[0] == ">":
+                if len(seq) > 0:
+                    break
+                continue
+            seq.append(line.strip().upper())
+    return np.frombuffer("".join(seq).encode(), dtype=np.uint8)
+
+def read_cds(gtf_file):
+    """Read the coding sequence segments of each gene from a gtf file, in the order genes first appear.
+
+    Returns a dictionary of gene_id to a list of (start, end) one-based inclusive segments, sorted by start.
+    """
+    cds = {}
+    with open(gtf_file) as inf:
+        for line in inf:
+            if line[0] == "#" or len(line.strip()) == 0:
+                continue
+            fields = line.rstrip("\n").split("\t")
+            if fields[2] != "CDS":
+                continue
+            if fields[6] == "-":
+                raise ValueError("Coding sequences on the reverse strand are not supported: {}".format(line.strip()))
+            gene = fields[8].split('gene_id "')[1].split('"')[0]
+            cds.setdefault(gene, []).append((int(fields[3]), int(fields[4])))
+    return {gene:sorted(segments) for gene, segments in cds.items()}
+
+class CodonMap:
+    """Lookup tables from genome positions to the codons containing them, built once from a reference and its gene annotation.
+
+    Each coding base is an entry giving its gene, codon and place in the codon. A base can belong to several genes,
+    so ORF1a changes are reported under both ORF1a and ORF1ab when the annotation lists both, and a base repeated by a
+    ribosomal slippage site (as in the two ORF1ab segments) belongs to two codons of the same gene.
+    """
+    def __init__(self, fasta_file, gtf_file):
+        self.reference = read_reference(fasta_file)
+        self.genes = []
+        codons = []
+        for gene, segments in read_cds(gtf_file).items():
+            positions = np.concatenate([np.arange(start, end + 1) for start, end in segments])
+            #the final partial codon, if any, cannot be translated.
+            positions = positions[:len(positions) - len(positions) % 3].reshape(-1, 3)
+            codons.append((len(self.genes), positions))
+            self.genes.append(gene)
+        #codon_positions holds the three genome positions of every codon of every gene.
+        self.codon_positions = np.concatenate([p for _, p in codons]).astype(np.int64)
+        self.codon_gene = np.concatenate([np.full(len(p), g, dtype=np.int32) for g, p in codons])
+        self.codon_number = np.concatenate([np.arange(1, len(p) + 1, dtype=np.int32) for _, p in codons])
+        #entries sorted by genome position, ties kept in gene order.
+        entry_pos = self.codon_positions.ravel()
+        order = np.argsort(entry_pos, kind='stable')
+        self.entry_pos = entry_pos[order]
+        self.entry_codon = order // 3
+        self.entry_frame = order % 3
+        #codon lookup over base codes 0-3 (TCAG) with 4 for anything else, translated as X.
+        self.base_code = np.full(256, 4, dtype=np.int64)
+        for i, b in enumerate(BASES):
+            self.base_code[ord(b)] = i
+        self.aa_table = np.full(125, ord("X"), dtype=np.uint8)
+        for i, aa in enumerate(AMINO_ACIDS):
+            self.aa_table[(i // 16) * 25 + (i // 4 % 4) * 5 + i % 4] = ord(aa)
+
+    def translate_codons(self, codons):
+        """Translate an (n, 3) array of character codes to amino acid character codes.
+        """
+        c = self.base_code[codons]
+        return self.aa_table[c[:, 0] * 25 + c[:, 1] * 5 + c[:, 2]]
+
+def nucleotide_states(index, reference, mut_rows, positions, nodes):
+    """Return the nucleotide at each of a set of genome positions on each of a set of nodes, as character codes.
+
+    Args:
+        index (TreeIndex): The tree.
+        reference (np.array): Reference sequence character codes.
+        mut_rows (np.array): Rows of the mutation table to consider. Must include every mutation at the queried positions on the queried nodes and their ancestors.
+        positions (np.array): One-based genome positions to query.
+        nodes (np.array): Node ordinals to query, paired with positions. -1 queries the reference.
+
+    Every mutation at a position opens a state at the first ordinal of its subtree and closes it after its own ordinal.
+    Sorting these events by position and ordinal, the state of a query is set by the last event at or before it;
+    a closing event restores whatever the event before the matching opening set, which is resolved for all events
+    at once by pointer jumping.
+    """
+    nodes = np.asarray(nodes, dtype=np.int64)
+    positions = np.asarray(positions, dtype=np.int64)
+    mut_nodes = index.mutation_nodes()[mut_rows]
+    mut_pos = index.mut_loc[mut_rows].astype(np.int64)
+    span = 3 * (index.size + 1)
+    m = len(mut_rows)
+    ev_pos = np.concatenate([mut_pos, mut_pos])
+    ev_key = ev_pos * span + np.concatenate([3 * index.first[mut_nodes], 3 * mut_nodes + 2])
+    #nested subtrees can open at the same ordinal; the outer one opens first.
+    order = np.lexsort((np.concatenate([-mut_nodes, np.zeros(m, dtype=np.int64)]), ev_key))
+    ev_key = ev_key[order]
+    ev_pos = ev_pos[order]
+    ev_alt = np.concatenate([index.mut_alt[mut_rows], np.zeros(m, dtype=np.uint8)])[order]
+    sorted_at = np.empty(2 * m, dtype=np.int64)
+    sorted_at[order] = np.arange(2 * m)
+    #each closing event points to the event just before its opening one, or -1 for the reference.
+    pointer = np.arange(2 * m)
+    before = sorted_at[:m] - 1
+    same = before >= 0
+    same[same] = ev_pos[before[same]] == mut_pos[same]
+    before[~same] = -1
+    pointer[sorted_at[m:]] = before
+    #opening events point to themselves, so following pointers ends at an opening event or the reference.
+    while True:
+        jumped = np.where(pointer >= 0, pointer[np.maximum(pointer, 0)], -1)
+        if np.array_equal(jumped, pointer):
+            break
+        pointer = jumped
+    states = reference[positions - 1].copy()
+    last = np.searchsorted(ev_key, positions * span + 3 * nodes + 1, side='right') - 1
+    found = (nodes >= 0) & (last >= 0)
+    found[found] = ev_pos[last[found]] == positions[found]
+    source = np.where(found, pointer[np.maximum(last, 0)], -1)
+    states[source >= 0] = ev_alt[source[source >= 0]]
+    return states
+
+class AAChange:
+    """A single amino acid change caused by one nucleotide mutation on a node, with the attributes the scripts use from bte's translation output.
+    """
+    def __init__(self, gene, aa_index, original_aa, alternative_aa, nt_index, original_nt, alternative_nt, original_codon, alternative_codon):
+        self.gene = gene
+        self.aa_index = aa_index
+        self.original_aa = original_aa
+        self.alternative_aa = alternative_aa
+        self.nt_index = nt_index
+        self.original_nt = original_nt
+        self.alternative_nt = alternative_nt
+        self.original_codon = original_codon
+        self.alternative_codon = alternative_codon
+        self.aa = original_aa + str(aa_index) + alternative_aa
+
+    def is_synonymous(self):
+        return self.original_aa == self.alternative_aa
+
+    def aa_string(self):
+        return self.gene + ":" + self.aa
+
+class TranslationTable:
+    """Amino acid changes of every node stored column by column, grouped by node ordinal.
+
+    Changes of node o are rows offsets[o]:offsets[o+1]. Genes are codes into genes; amino acids, nucleotides and codons are character codes.
+    Supports the dictionary access the scripts use on the output of MATree.translate; AAChange objects are only built for the nodes requested.
+    A table translating only some nodes has covered set to a boolean mask of them; it is None when every node was translated.
+    """
+    COLUMNS = ('gene', 'aa_index', 'original_aa', 'alternative_aa', 'nt_index', 'original_nt', 'alternative_nt', 'original_codon', 'alternative_codon')
+
+    def __init__(self, index, genes, offsets, columns, covered = None):
+        self.ids = index.ids
+        self.ordinals = index.index
+        self.genes = genes
+        self.offsets = offsets
+        self.columns = columns
+        self.covered = covered
+
+    def save(self, path):
+        #write next to the destination and rename, so a concurrent reader never loads a partial file.
+        tmp = path + ".tmp.{}".format(os.getpid())
+        with open(tmp, "wb") as outf:
+            extra = {} if self.covered is None else {'covered':self.covered}
+            np.savez(outf, genes=np.array(self.genes, dtype=str), offsets=self.offsets, **extra, **self.columns)
+        os.replace(tmp, path)
+
+    @classmethod
+    def load(cls, index, path):
+        with np.load(path) as data:
+            covered = data['covered'] if 'covered' in data.files else None
+            return cls(index, [str(g) for g in data['genes']], data['offsets'], {k:data[k] for k in cls.COLUMNS}, covered)
+
+    def covers(self, nodes = None):
+        """Whether every node in the boolean mask nodes, or every node of the tree if None, was translated.
+        """
+        if self.covered is None:
+            return True
+        if nodes is None:
+            return False
+        return not (nodes & ~self.covered).any()
+
+    def get_changes(self, o):
+        """Return the AAChange objects of node ordinal o.
+        """
+        c = self.columns
+        changes = []
+        for r in range(self.offsets[o], self.offsets[o+1]):
+            changes.append(AAChange(self.genes[c['gene'][r]], int(c['aa_index'][r]), chr(c['original_aa'][r]), chr(c['alternative_aa'][r]),
+                                    int(c['nt_index'][r]), chr(c['original_nt'][r]), chr(c['alternative_nt'][r]),
+                                    c['original_codon'][r].tobytes().decode(), c['alternative_codon'][r].tobytes().decode()))
+        return changes
+
+    def get(self, nid, default = None):
+        o = self.ordinals.get(nid)
+        if o == None or self.offsets[o] == self.offsets[o+1]:
+            return default
+        return self.get_changes(o)
+
+    def __getitem__(self, nid):
+        changes = self.get(nid)
+        if changes == None:
+            raise KeyError(nid)
+        return changes
+
+    def __contains__(self, nid):
+        return self.get(nid) != None
+
+    def __len__(self):
+        return int(np.count_nonzero(np.diff(self.offsets)))
+
+    def keys(self):
+        return [self.ids[o] for o in np.nonzero(np.diff(self.offsets))[0]]
+
+    def items(self):
+        for o in np.nonzero(np.diff(self.offsets))[0]:
+            yield self.ids[o], self.get_changes(o)
+
+def translate_tree(index, codon_map, nodes = None):
+    """Translate the mutations of the tree, or of the nodes in a boolean mask, into amino acid changes.
+
+    Every mutation in a coding region yields one change per codon containing it, comparing the codon on the parent
+    with the codon after all of the node's own mutations. Codon states are looked up for all mutations in one batch.
+    """
+    mut_nodes = index.mutation_nodes()
+    rows = np.arange(len(mut_nodes))
+    if nodes is not None:
+        rows = rows[nodes[mut_nodes]]
+    #expand each mutation into the coding entries at its position.
+    loc = index.mut_loc[rows]
+    lo = np.searchsorted(codon_map.entry_pos, loc, side='left')
+    hi = np.searchsorted(codon_map.entry_pos, loc, side='right')
+    counts = hi - lo
+    row = np.repeat(rows, counts)
+    entry = np.repeat(lo - np.cumsum(counts) + counts, counts) + np.arange(counts.sum())
+    codon = codon_map.entry_codon[entry]
+    node = mut_nodes[row]
+    positions = codon_map.codon_positions[codon]
+    #only mutations at the codon positions involved, on the translated nodes or above them, can set their states.
+    relevant = np.isin(index.mut_loc, np.unique(positions))
+    if nodes is not None:
+        relevant &= (nodes | index.ancestor_mask(np.nonzero(nodes)[0]))[mut_nodes]
+    mut_rows = np.nonzero(relevant)[0]
+    query_nodes = np.concatenate([np.repeat(index.parent[node], 3), np.repeat(node, 3)])
+    states = nucleotide_states(index, codon_map.reference, mut_rows, np.concatenate([positions.ravel(), positions.ravel()]), query_nodes)
+    original_codon = states[:len(states)//2].reshape(-1, 3)
+    alternative_codon = states[len(states)//2:].reshape(-1, 3)
+    columns = {
+        'gene':codon_map.codon_gene[codon],
+        'aa_index':codon_map.codon_number[codon],
+        'original_aa':codon_map.translate_codons(original_codon),
+        'alternative_aa':codon_map.translate_codons(alternative_codon),
+        'nt_index':index.mut_loc[row],
+        'original_nt':original_codon[np.arange(len(row)), codon_map.entry_frame[entry]],
+        'alternative_nt':index.mut_alt[row],
+        'original_codon':original_codon,
+        'alternative_codon':alternative_codon,
+    }
+    offsets = np.zeros(index.size + 1, dtype=np.int64)
+    np.cumsum(np.bincount(node, minlength=index.size), out=offsets[1:])
+    return TranslationTable(index, codon_map.genes, offsets, columns, None if nodes is None else nodes.copy())
+
+def translation_path(cache_dir, index, fasta_file, gtf_file):
+    """Return the cache file for a translation, keyed by the tree's mutations and topology and the contents of the reference and annotation files.
+    """
+    h = hashlib.sha256()
+    h.update(index.content_hash().encode())
+    h.update(file_hash(fasta_file).encode())
+    h.update(file_hash(gtf_file).encode())
+    return os.path.join(cache_dir, "translation.{}.npz".format(h.hexdigest()))
+
+def load_translation(index, fasta_file, gtf_file, cache_dir, nodes = None):
+    """Return the translation of the tree, reading it from the cache if the same tree, reference and annotation were translated before.
+
+    Args:
+        index (TreeIndex): The tree.
+        fasta_file (str): Reference genome fasta.
+        gtf_file (str): Gene annotation gtf.
+        cache_dir (str): Directory holding cached translations.
+        nodes (np.array): Boolean mask of the nodes whose changes are needed. Default all. The cached translation is
+            used if it covers these nodes; otherwise they are translated along with the nodes it does cover, and the
+            result replaces it, so runs with different masks share one cache.
+    """
+    path = translation_path(cache_dir, index, fasta_file, gtf_file)
+    tree_file = getattr(index, "tree_file", None)
+    if tree_file != None and os.path.abspath(cache_dir) != snapshot_dir(tree_file):
+        tree_file = None
+    if os.path.exists(path):
+        cached = TranslationTable.load(index, path)
+        if cached.covers(nodes):
+            if tree_file != None:
+                record_snapshot(path, tree_file, "translation")
+            return cached
+        if nodes is not None:
+            nodes = nodes | cached.covered
+    table = translate_tree(index, CodonMap(fasta_file, gtf_file), nodes)
+    os.makedirs(cache_dir, exist_ok=True)
+    table.save(path)
+    if tree_file != None:
+        record_snapshot(path, tree_file, "translation")
+    return table
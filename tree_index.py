@@ -0,0 +1,587 @@
+import os
+import re
+import json
+import time
+import fcntl
+import shutil
+import hashlib
+import tempfile
+import contextlib
+import numpy as np
+from multiprocessing import shared_memory
+
+def process_mstr(mstr):
+    """Read a mutation string and return the chromosome, location, reference, and alternate alleles.
+    """
+    if ":" in mstr:
+        chro = mstr.split(":")[0]
+        data = mstr.split(":")[1]
+    else:
+        chro = None
+        data = mstr
+    if data[0].isdigit():
+        loc = int(data[:-1])
+        ref = None
+        alt = data[-1]
+    else:
+        loc = int(data[1:-1])
+        ref = data[0]
+        alt = data[-1]
+    return chro, loc, ref, alt
+
+class TreeIndex:
+    """Compact array representation of a MATree, built once per run.
+
+    Nodes are numbered by their postorder position, so every subtree occupies a contiguous
+    range of ordinals ending with its root, and children always have smaller ordinals than their parent.
+    Children of a node are stored in CSR form (child_offsets/children) in their original order.
+    """
+    def __init__(self, t):
+        nodes = []
+        parents = []
+        depths = []
+        #walk the tree visiting the last child first; reversing this order yields a left-to-right postorder.
+        stack = [(t.root, -1)]
+        while len(stack) > 0:
+            node, ppos = stack.pop()
+            pos = len(nodes)
+            nodes.append(node)
+            parents.append(ppos)
+            depths.append(0 if ppos < 0 else depths[ppos] + 1)
+            for child in node.children:
+                stack.append((child, pos))
+        nodes.reverse()
+        n = len(nodes)
+        self.size = n
+        self.ids = [node.id for node in nodes]
+        self.index = {nid:i for i, nid in enumerate(self.ids)}
+        self.parse_mutations([node.mutations for node in nodes])
+        self.parse_annotations([node.annotations for node in nodes])
+        self.branch_length = np.array([node.branch_length for node in nodes], dtype=np.float64)
+        ppos = np.array(parents[::-1], dtype=np.int64)
+        self.parent = np.where(ppos < 0, -1, n - 1 - ppos)
+        self.depth = np.array(depths[::-1], dtype=np.int64)
+        #children grouped by parent; a stable sort keeps siblings in their original left-to-right order.
+        has_parent = np.nonzero(self.parent >= 0)[0]
+        self.children = has_parent[np.argsort(self.parent[has_parent], kind='stable')]
+        self.child_offsets = np.zeros(n + 1, dtype=np.int64)
+        np.cumsum(np.bincount(self.parent[has_parent], minlength=n), out=self.child_offsets[1:])
+        self.is_leaf = self.child_offsets[1:] == self.child_offsets[:-1]
+        #nodes sorted by depth, then ordinal, is exactly the breadth-first order of the tree.
+        self.bfs = np.argsort(self.depth, kind='stable')
+        self.level_bounds = np.searchsorted(self.depth[self.bfs], np.arange(self.depth.max() + 2))
+        #the first ordinal of each subtree, found by pushing minima up one level at a time.
+        self.first = np.arange(n, dtype=np.int64)
+        for d in range(len(self.level_bounds) - 2, 0, -1):
+            level = self.bfs[self.level_bounds[d]:self.level_bounds[d+1]]
+            np.minimum.at(self.first, self.parent[level], self.first[level])
+        self.index_leaves()
+
+    def index_leaves(self):
+        #leaves in ordinal order. With first and the ordinal itself as entry and exit times,
+        #the leaves under node o are the contiguous slice leaf_order[leaf_before[first[o]]:leaf_before[o+1]].
+        self.leaf_order = np.nonzero(self.is_leaf)[0]
+        self.leaf_before = np.zeros(self.size + 1, dtype=np.int64)
+        np.cumsum(self.is_leaf, out=self.leaf_before[1:])
+
+    def parse_mutations(self, mutations):
+        """Store the mutations of every node as a columnar table, parsing each distinct mutation string only once.
+
+        Mutations of node o are rows mut_offsets[o]:mut_offsets[o+1] of mut_loc, mut_ref and mut_alt.
+        Alleles are stored as character codes, with 0 for an unrecorded reference.
+        """
+        self.mut_offsets = np.zeros(len(mutations) + 1, dtype=np.int64)
+        np.cumsum([len(m) for m in mutations], out=self.mut_offsets[1:])
+        unique = {}
+        rows = np.fromiter((unique.setdefault(m, len(unique)) for muts in mutations for m in muts), dtype=np.int64, count=self.mut_offsets[-1])
+        parsed = [process_mstr(m) for m in unique]
+        self.mut_loc = np.array([p[1] for p in parsed], dtype=np.int32)[rows]
+        self.mut_ref = np.array([0 if p[2] == None else ord(p[2]) for p in parsed], dtype=np.uint8)[rows]
+        self.mut_alt = np.array([ord(p[3]) for p in parsed], dtype=np.uint8)[rows]
+
+    def parse_annotations(self, annotations):
+        """Store node annotations as integer codes into annotation_names, one column per annotation index, with -1 for none.
+        """
+        ncol = max([len(a) for a in annotations] + [1])
+        self.annotation_names = []
+        codes = {}
+        self.annotations = np.full((len(annotations), ncol), -1, dtype=np.int32)
+        for o, anns in enumerate(annotations):
+            for c, a in enumerate(anns):
+                if len(a) > 0:
+                    if a not in codes:
+                        codes[a] = len(self.annotation_names)
+                        self.annotation_names.append(a)
+                    self.annotations[o, c] = codes[a]
+
+    def annotated_with(self, annotation):
+        """Return the ordinals of nodes carrying the annotation in any column.
+        """
+        if annotation not in self.annotation_names:
+            return np.zeros(0, dtype=np.int64)
+        return np.nonzero((self.annotations == self.annotation_names.index(annotation)).any(axis=1))[0]
+
+    def inherited_annotations(self):
+        """Return, for every node and annotation column, the code of the closest annotation at or above the node, or -1.
+
+        Filled by a single top-down pass over the levels of the tree and cached, so that any number of nodes can be read from it.
+        """
+        if getattr(self, 'inherited', None) is None:
+            self.inherited = self.annotations.copy()
+            for d in range(1, len(self.level_bounds) - 1):
+                level = self.bfs[self.level_bounds[d]:self.level_bounds[d+1]]
+                rows = self.inherited[level]
+                self.inherited[level] = np.where(rows >= 0, rows, self.inherited[self.parent[level]])
+        return self.inherited
+
+    def most_recent_annotation(self, o):
+        """Return the closest annotation at or above node o in each column, with None where there is none.
+        """
+        return [self.annotation_names[c] if c >= 0 else None for c in self.inherited_annotations()[o]]
+
+    def annotation_labels(self, nids, column, include_self = True, missing = None):
+        """Return the closest annotation in one column for each of a sequence of node ids.
+
+        Args:
+            nids (iterable): Node ids to look up.
+            column (int): Annotation column to read; negative values count from the last column.
+            include_self (bool): Whether an annotation on the node itself counts, or only those on its ancestors.
+            missing: Value returned for ids that are not in the tree.
+        Nodes without an annotation get None.
+        """
+        inherited = self.inherited_annotations()[:, column]
+        labels = []
+        for nid in nids:
+            o = self.index.get(nid)
+            if o == None:
+                labels.append(missing)
+                continue
+            if not include_self:
+                o = self.parent[o]
+            labels.append(self.annotation_names[inherited[o]] if o >= 0 and inherited[o] >= 0 else None)
+        return labels
+
+    def dump_annotations(self):
+        """Return a dictionary of each annotation to the id of the first node carrying it in depth-first order.
+        """
+        #in postorder, a subtree starts at its first ordinal and ancestors have larger ordinals than the nodes below them.
+        carriers = np.nonzero((self.annotations >= 0).any(axis=1))[0]
+        carriers = carriers[np.lexsort((-carriers, self.first[carriers]))]
+        annotes = {}
+        for o in carriers:
+            for c in self.annotations[o]:
+                if c >= 0 and self.annotation_names[c] not in annotes:
+                    annotes[self.annotation_names[c]] = self.ids[o]
+        return annotes
+
+    def get_mutations(self, o):
+        """Return the mutations of node o as strings.
+        """
+        rows = range(self.mut_offsets[o], self.mut_offsets[o+1])
+        return [(chr(self.mut_ref[r]) if self.mut_ref[r] > 0 else '') + str(self.mut_loc[r]) + chr(self.mut_alt[r]) for r in rows]
+
+    def subtree_mutation_count(self, nodes):
+        """Return the number of mutations in the subtree of each given node ordinal, including the node itself.
+
+        Subtrees are contiguous ordinal ranges, so mut_offsets already holds the running totals needed.
+        """
+        nodes = np.asarray(nodes, dtype=np.int64)
+        return self.mut_offsets[nodes + 1] - self.mut_offsets[self.first[nodes]]
+
+    def mutation_nodes(self):
+        """Return the node ordinal of each row of the mutation table.
+        """
+        return np.repeat(np.arange(self.size), np.diff(self.mut_offsets))
+
+    #the topology arrays needed to rebuild an index in another process.
+    TOPOLOGY = ('parent', 'depth', 'children', 'child_offsets', 'is_leaf', 'bfs', 'level_bounds', 'first')
+
+    def topology(self):
+        return {k:getattr(self, k) for k in self.TOPOLOGY}
+
+    @classmethod
+    def from_topology(cls, arrays):
+        """Rebuild an index from the arrays returned by topology(), without node ids or mutations.
+        """
+        index = cls.__new__(cls)
+        for k in cls.TOPOLOGY:
+            setattr(index, k, arrays[k])
+        index.size = len(index.parent)
+        index.index_leaves()
+        index.ids = None
+        index.index = None
+        index.branch_length = None
+        return index
+
+    #the arrays written to and memory-mapped from a snapshot directory, alongside the node ids and annotation names.
+    SNAPSHOT = TOPOLOGY + ('branch_length', 'leaf_order', 'leaf_before', 'mut_offsets', 'mut_loc', 'mut_ref', 'mut_alt', 'annotations')
+    SNAPSHOT_VERSION = 1
+
+    def save(self, path):
+        """Write the index to a snapshot directory that load can memory-map.
+
+        The snapshot is assembled in a temporary directory and renamed into place, so concurrent writers
+        and readers never see a partial snapshot.
+        """
+        parent = os.path.dirname(os.path.abspath(path))
+        os.makedirs(parent, exist_ok=True)
+        tmp = tempfile.mkdtemp(dir=parent, prefix=".tmp.")
+        try:
+            for k in self.SNAPSHOT:
+                np.save(os.path.join(tmp, k + ".npy"), getattr(self, k))
+            with open(os.path.join(tmp, "ids.txt"), "w") as outf:
+                outf.write("\n".join(self.ids))
+            with open(os.path.join(tmp, "annotation_names.txt"), "w") as outf:
+                outf.write("\n".join(self.annotation_names))
+            os.chmod(tmp, 0o755)
+            os.rename(tmp, path)
+        except OSError:
+            #another process finished the same snapshot first.
+            if not os.path.isdir(path):
+                raise
+        finally:
+            if os.path.isdir(tmp):
+                shutil.rmtree(tmp)
+
+    @classmethod
+    def load(cls, path):
+        """Memory-map an index written by save. Arrays are read-only and shared with other processes through the page cache.
+        """
+        index = cls.__new__(cls)
+        for k in cls.SNAPSHOT:
+            setattr(index, k, np.load(os.path.join(path, k + ".npy"), mmap_mode='r'))
+        with open(os.path.join(path, "ids.txt")) as inf:
+            index.ids = inf.read().split("\n")
+        with open(os.path.join(path, "annotation_names.txt")) as inf:
+            names = inf.read()
+            index.annotation_names = names.split("\n") if len(names) > 0 else []
+        index.size = len(index.ids)
+        index.index = {nid:i for i, nid in enumerate(index.ids)}
+        return index
+
+    def content_hash(self):
+        """Return a hex digest of the node ids, topology and mutations, which is unchanged by annotating the tree.
+        """
+        h = hashlib.sha256()
+        h.update("\n".join(self.ids).encode())
+        for k in ('parent', 'mut_offsets', 'mut_loc', 'mut_ref', 'mut_alt'):
+            h.update(np.ascontiguousarray(getattr(self, k)).tobytes())
+        return h.hexdigest()
+
+    def ordinal(self, nid):
+        return self.index[nid]
+
+    def get_children(self, o):
+        return self.children[self.child_offsets[o]:self.child_offsets[o+1]]
+
+    def is_ancestor(self, a, b):
+        """Whether node a is node b or one of its ancestors.
+        """
+        return self.first[a] <= b <= a
+
+    def get_leaves(self, o = None):
+        """Return the ordinals of the leaves under node o, or of every leaf.
+        """
+        if o == None:
+            return self.leaf_order
+        return self.leaf_order[self.leaf_before[self.first[o]]:self.leaf_before[o+1]]
+
+    def get_leaves_ids(self, o = None):
+        return [self.ids[l] for l in self.get_leaves(o)]
+
+    def leaf_count(self, o):
+        return int(self.leaf_before[o+1] - self.leaf_before[self.first[o]])
+
+    def descendant_mask(self, roots):
+        """Return a boolean mask of the nodes at or below any of the given node ordinals.
+        """
+        edges = np.zeros(self.size + 1, dtype=np.int64)
+        roots = np.asarray(roots, dtype=np.int64)
+        np.add.at(edges, self.first[roots], 1)
+        np.add.at(edges, roots + 1, -1)
+        return np.cumsum(edges[:-1]) > 0
+
+    def ancestor_mask(self, targets):
+        """Return a boolean mask of the nodes at or above any of the given node ordinals.
+        """
+        marked = np.zeros(self.size + 1, dtype=np.int64)
+        marked[np.asarray(targets, dtype=np.int64) + 1] = 1
+        marked = np.cumsum(marked)
+        nodes = np.arange(self.size)
+        return marked[nodes + 1] - marked[self.first] > 0
+
+    def ancestors(self, o, include_self = True):
+        """Yield the ordinals on the path from node o up to the root."""
+        if not include_self:
+            o = self.parent[o]
+        while o >= 0:
+            yield o
+            o = self.parent[o]
+
+    def clade(self, nid):
+        return Clade(self, self.index[nid])
+
+class PathWalker:
+    """Walks from nodes toward the root of an index, collecting what the lineage reports need about each path.
+
+    Haplotypes and the mutations above each node are memoized by node and built from the closest memoized
+    ancestor, so proposals sharing ancestors only walk the part of their path that is new.
+    """
+    def __init__(self, index):
+        self.index = index
+        self.haplotypes = {}
+        self.ancestral = {}
+
+    def path(self, o, stop = None):
+        """Return the ordinals from node o toward the root, stopping before stop if it is on the path.
+        """
+        path = []
+        while o >= 0 and o != stop:
+            path.append(o)
+            o = self.index.parent[o]
+        return path
+
+    def haplotype(self, o):
+        """Return the set of mutations node o carries with respect to the root, with reverted mutations cancelled out.
+        """
+        chain = []
+        while o >= 0 and o not in self.haplotypes:
+            chain.append(o)
+            o = self.index.parent[o]
+        hap = self.haplotypes.get(o, frozenset())
+        for n in reversed(chain):
+            hap = set(hap)
+            for m in self.index.get_mutations(n):
+                opposite = m[-1] + m[1:-1] + m[0]
+                if opposite in hap:
+                    hap.remove(opposite)
+                else:
+                    hap.add(m)
+            hap = frozenset(hap)
+            self.haplotypes[n] = hap
+        return hap
+
+    def ancestral_mutations(self, o):
+        """Return where each mutation occurs from node o up to the root, as a dictionary of mutation to the
+        (negative depth, place within node) of each occurrence; sorting these keys orders occurrences from o upward.
+        """
+        chain = []
+        while o >= 0 and o not in self.ancestral:
+            chain.append(o)
+            o = self.index.parent[o]
+        table = self.ancestral.get(o, {})
+        for n in reversed(chain):
+            table = dict(table)
+            depth = -int(self.index.depth[n])
+            for i, m in enumerate(self.index.get_mutations(n)):
+                table[m] = table.get(m, ()) + ((depth, i),)
+            self.ancestral[n] = table
+        return table
+
+    def reversions(self, o):
+        """Return the mutations between node o and its closest annotated ancestor that undo a mutation at or above that ancestor.
+
+        Only the path up to the ancestor is walked; the mutations at and above it are looked up in its memoized table.
+        """
+        allm = set()
+        n = o
+        while True:
+            allm.update(self.index.get_mutations(n))
+            n = self.index.parent[n]
+            if n < 0:
+                return []
+            if (self.index.annotations[n] >= 0).any():
+                break
+        upper = self.ancestral_mutations(n)
+        found = []
+        for m in allm:
+            opposite = m[-1] + m[1:-1] + m[0]
+            found.extend((key, m) for key in upper.get(opposite, ()))
+        return [m for _, m in sorted(found)]
+
+    def walk(self, child, parent):
+        """Collect the path summaries of a proposed lineage in one walk from child up to parent.
+
+        Returns the mutations separating the two (nodes joined by '>' from the parent side, mutations within a node by ','),
+        the separating mutations collapsed to the latest one at each location without its reference base, the reversions
+        of the child, and the haplotype of the child minus that of the parent.
+        """
+        between = self.path(child, parent)
+        mutations = [self.index.get_mutations(n) for n in between]
+        mset = []
+        locs = set()
+        for muts in mutations:
+            for m in muts:
+                location = int(m[1:-1])
+                if location not in locs:
+                    locs.add(location)
+                    mset.append(m[1:])
+        separating = ">".join([",".join(muts) for muts in mutations[::-1]])
+        return separating, ",".join(mset), self.reversions(child), self.haplotype(child) - self.haplotype(parent)
+
+def file_hash(path):
+    """Return the SHA-256 hex digest of a file, read in blocks.
+    """
+    h = hashlib.sha256()
+    with open(path, "rb") as inf:
+        for block in iter(lambda: inf.read(1 << 20), b""):
+            h.update(block)
+    return h.hexdigest()
+
+def snapshot_dir(tree_file):
+    """Return the directory holding snapshots and other cached data for trees stored next to tree_file.
+    """
+    return os.path.join(os.path.dirname(os.path.abspath(tree_file)), ".tree_snapshots")
+
+def snapshot_path(tree_file):
+    """Return the snapshot directory for a tree file, keyed by the hash of its contents.
+    """
+    return os.path.join(snapshot_dir(tree_file), "{}.v{}".format(file_hash(tree_file), TreeIndex.SNAPSHOT_VERSION))
+
+#names of the entries in a snapshot directory that are recorded against their source files and pruned with them;
+#most are keyed by a content hash, and so replaced when their source changes.
+SNAPSHOT_ENTRY = re.compile(r"^((metadata\.|translation\.|weekly_counts\.|escape_scores\.)?[0-9a-f]{64}(\.v[0-9]+)?(\.npz|\.json)?|lapis_counts\.json)$")
+
+@contextlib.contextmanager
+def snapshot_manifest(directory):
+    """Lock the manifest of a snapshot directory and yield it for reading and updating; changes are saved on exit.
+
+    The manifest maps the name of each source file next to the directory to the entries holding its cached data,
+    as {source: {kind: [entry, last used]}}.
+    """
+    os.makedirs(directory, exist_ok=True)
+    path = os.path.join(directory, "sources.json")
+    with open(os.path.join(directory, ".lock"), "w") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        manifest = {}
+        if os.path.exists(path):
+            with open(path) as inf:
+                manifest = json.load(inf)
+        yield manifest
+        tmp = path + ".tmp.{}".format(os.getpid())
+        with open(tmp, "w") as outf:
+            json.dump(manifest, outf)
+        os.replace(tmp, path)
+
+def remove_entry(path):
+    if os.path.isdir(path):
+        shutil.rmtree(path)
+    elif os.path.exists(path):
+        os.remove(path)
+
+def record_snapshot(path, source_file, kind):
+    """Record the snapshot directory entry at path as the current cached data of a kind for source_file.
+
+    The entry it replaces, left over from earlier contents of the source, is deleted unless another source still
+    uses it, so each source keeps only the data for its current contents.
+    """
+    directory, name = os.path.split(os.path.abspath(path))
+    with snapshot_manifest(directory) as manifest:
+        kinds = manifest.setdefault(os.path.basename(source_file), {})
+        old = kinds.get(kind)
+        kinds[kind] = [name, time.time()]
+        if old != None and old[0] != name and all(old[0] != e for k in manifest.values() for e, _ in k.values()):
+            remove_entry(os.path.join(directory, old[0]))
+
+def prune_snapshots(directory, max_age = None):
+    """Delete the content-keyed entries of a snapshot directory that no current source file uses.
+
+    Sources that no longer exist are forgotten first, as are entries not used in the last max_age days, if given.
+    Entries that were never recorded, such as those written before sources were tracked, are deleted as well.
+    Returns the names of the deleted entries.
+    """
+    if not os.path.isdir(directory):
+        return []
+    parent = os.path.dirname(os.path.abspath(directory))
+    with snapshot_manifest(directory) as manifest:
+        for source in list(manifest):
+            if not os.path.exists(os.path.join(parent, source)):
+                del manifest[source]
+                continue
+            if max_age != None:
+                for kind, (entry, used) in list(manifest[source].items()):
+                    if time.time() - used > max_age * 86400:
+                        del manifest[source][kind]
+        current = set(e for k in manifest.values() for e, _ in k.values())
+        removed = [name for name in os.listdir(directory) if SNAPSHOT_ENTRY.match(name) and name not in current]
+        for name in removed:
+            remove_entry(os.path.join(directory, name))
+    return removed
+
+def load_tree_index(tree_file, t = None):
+    """Load the index of a protobuf tree from its snapshot, writing the snapshot first if there is none.
+
+    Args:
+        tree_file (str): Path to the protobuf the index describes.
+        t (MATree): The already loaded tree, if any. Only used when no snapshot exists; otherwise the tree is loaded from tree_file.
+    """
+    path = snapshot_path(tree_file)
+    if os.path.isdir(path):
+        index = TreeIndex.load(path)
+    else:
+        if t == None:
+            import bte
+            t = bte.MATree(tree_file)
+        index = TreeIndex(t)
+        index.save(path)
+    record_snapshot(path, tree_file, "tree")
+    #data derived from the tree, such as its translation, is recorded under the same file.
+    index.tree_file = tree_file
+    return index
+
+class Clade:
+    """The contiguous ordinal range of a single subtree, with zero-based local arrays for passes over it.
+
+    Local position i corresponds to tree ordinal lo + i; the clade root is always the last position.
+    """
+    def __init__(self, index, root):
+        self.lo = int(index.first[root])
+        self.hi = int(root) + 1
+        self.size = self.hi - self.lo
+        self.root = self.size - 1
+        self.parent = index.parent[self.lo:self.hi] - self.lo
+        self.parent[self.root] = -1
+        self.is_leaf = index.is_leaf[self.lo:self.hi]
+        depth = index.depth[self.lo:self.hi] - index.depth[root]
+        self.bfs = np.argsort(depth, kind='stable')
+        bounds = np.searchsorted(depth[self.bfs], np.arange(depth.max() + 2))
+        #levels[d] holds the local positions at depth d below the clade root, in breadth-first order.
+        self.levels = [self.bfs[bounds[d]:bounds[d+1]] for d in range(len(bounds) - 1)]
+
+    def local(self, o):
+        return o - self.lo
+
+    def ancestors(self, i):
+        """Yield the local positions on the path from local position i up to the clade root."""
+        while i >= 0:
+            yield i
+            i = self.parent[i]
+
+def share_arrays(arrays):
+    """Copy a dictionary of arrays into shared memory, so that worker processes can attach to them instead of receiving pickled copies.
+
+    Returns the shared views, the blocks backing them (the caller must close and unlink these), and a picklable spec for attach_arrays.
+    """
+    views = {}
+    blocks = []
+    spec = {}
+    for k, arr in arrays.items():
+        arr = np.ascontiguousarray(arr)
+        shm = shared_memory.SharedMemory(create=True, size=max(arr.nbytes, 1))
+        blocks.append(shm)
+        view = np.ndarray(arr.shape, dtype=arr.dtype, buffer=shm.buf)
+        view[...] = arr
+        views[k] = view
+        spec[k] = (shm.name, arr.shape, arr.dtype.str)
+    return views, blocks, spec
+
+def attach_arrays(spec):
+    """Attach to arrays placed in shared memory by share_arrays. The blocks must stay referenced while the views are in use.
+    """
+    views = {}
+    blocks = []
+    for k, (name, shape, dtype) in spec.items():
+        shm = shared_memory.SharedMemory(name=name)
+        blocks.append(shm)
+        views[k] = np.ndarray(shape, dtype=np.dtype(dtype), buffer=shm.buf)
+    return views, blocks
@@ -2,12 +2,14 @@ import sys
 sys.path.append("~/bin:")
 import argparse
 import pandas as pd
-import bte
+from tree_index import load_tree_index
+from metadata_store import load_metadata_store
 import numpy as np
 import os
 from github import Github
 import glob
-import datetime as dt
+import sqlite3
+from concurrent.futures import ProcessPoolExecutor
 
 def argparser():
     parser = argparse.ArgumentParser(description="Write markdown issues representing the top N proposed sublineages of a report.")
@@ -21,15 +23,10 @@ def argparser():
     parser.add_argument("-l", "--local", action='store_true', help="Set to write issues to local files only. Default posts issues to https://github.com/jmcbroome/auto-pango-designation/issues")
     parser.add_argument("-c", "--samplecount", default=15, type=int, help="Include up to this many sample names in the text of the report proposing the lineage.")
     parser.add_argument("-k", "--skip", action='store_true', help="Use to skip reporting any lineages that overlap with sample sets enumerated in *_samples.txt files in this directory.")
+    parser.add_argument("--threads", default=1, type=int, help="Number of worker processes used to render sample lists and reports. Default 1")
     args = parser.parse_args()
     return args
  
-def get_date(d):
-    try:
-        return dt.datetime.strptime(d,"%Y-%m-%d")
-    except:
-        return np.nan
-
 def write_report(row, prefix, samplenames, samplecount, treename = None, treenode = None):
     fstr = []
     fstr.append("{} is a proposed sublineage of {} that includes {} samples.".format(row.proposed_sublineage, row.parent, row.proposed_sublineage_size))
@@ -111,61 +108,129 @@ def write_report(row, prefix, samplenames, samplecount, treename = None, treenod
         fstr.append("As well as {} additional samples.".format(remainder))
     return fstr, ','.join(fortitle), common
 
-def write_sample_list(t, mdf, nid, name, prefix, count, skipset):
-    selection = []
-    with open(prefix + name + "_samples.txt","w+") as outf:
-        # samples = t.get_leaves_ids(nid)
-        #ensure that among the sample names printed, at least two have their MRCA at the node root. 
-        samples = []
-        childset = {}
-        for child in t.get_node(nid).children:
-            cs = t.get_leaves_ids(child.id)
-            for s in cs:
-                samples.append(s)
-                childset[s] = child.id
-            # samples.extend(cs)
-            # childset[child.id] = set(cs)
-        if any([s for s in samples if s in skipset]):
-            print("Proposal {} overlaps with existing proposals; skipping")
-            return [], len(samples)
-        metadata = mdf[mdf.strain.isin(samples)]
-        metadata['FromChild'] = metadata.strain.apply(lambda x:childset[s])
-        if metadata.shape[0] == 0:
-            print("None of the samples of lineage {} have accompanying metadata; skipping".format(name))
-            return [], len(samples)
-        def print_sample_info(row):
-            try:
-                datestr = row.date.strftime("%Y-%m-%d")
-            except ValueError:
-                datestr = "NaN"
-            print("\t".join([str(v) for v in [row.strain, row.country, datestr]],),file=outf)
-        metadata.apply(print_sample_info,axis=1)
-        #pick one from each child group. This ensures that the LCA of the named group is the correct root of the lineage.
-        selection.extend(metadata.groupby("FromChild", group_keys=False).strain.sample(1)) 
-        remaining = metadata[~metadata.strain.isin(selection)]
-        selection.extend(remaining.strain.sample(min([count - len(selection), remaining.shape[0]]), replace=False))
-        assert len(selection) <= count
-    return selection, len(samples)
-
-def get_current_proposed_covered():
-    samset = set()
-    sfiles = glob.glob("*_samples.txt")
-    for f in sfiles:
-        with open(f) as inf:
-            for entry in inf:
-                try:
-                    sample, country, date = entry.strip().split()
-                    samset.add(sample)
-                except:
-                    print("WARNING: following did not parse correctly")
-                    print(entry)
-                    continue
-    return samset
-
-def write_json(t, nid, parent_nid, name, prefix, size, metafile = None):
+def proposal_samples(index, leaf_rows, mdf, nid):
+    """Return the leaf sample names of a proposal, and the metadata of those samples in date order with the child of the proposal root each descends from.
+
+    Args:
+        index (TreeIndex): Index of the tree.
+        leaf_rows (np.array): Position in mdf of the metadata for each leaf, in leaf order, or -1 for leaves without metadata.
+        mdf (pd.DataFrame): Metadata sorted by date.
+        nid (str): Node id of the proposal root.
+    """
+    #the leaves under each child are a contiguous run of the leaf order, so the runs of the children make up the proposal.
+    o = index.ordinal(nid)
+    children = index.get_children(o)
+    lo = index.leaf_before[index.first[o]]
+    hi = index.leaf_before[o+1] if len(children) > 0 else lo
+    fromchild = np.empty(hi - lo, dtype=object)
+    for child in children:
+        fromchild[index.leaf_before[index.first[child]]-lo:index.leaf_before[child+1]-lo] = index.ids[child]
+    samples = [index.ids[l] for l in index.leaf_order[lo:hi]]
+    rows = leaf_rows[lo:hi]
+    order = np.argsort(rows, kind='stable')
+    order = order[rows[order] >= 0]
+    metadata = mdf.iloc[rows[order]].copy()
+    metadata['FromChild'] = fromchild[order]
+    return samples, metadata
+
+def write_sample_list(metadata, count, seed):
+    """Return the sample, country and date lines for the metadata of a proposal, and a selection of up to count sample names.
+
+    The selection includes at least one sample descending from each child of the proposal root.
+    """
+    rng = np.random.RandomState(seed)
+    def print_sample_info(row):
+        try:
+            datestr = row.date.strftime("%Y-%m-%d")
+        except ValueError:
+            datestr = "NaN"
+        return "\t".join([str(v) for v in [row.strain, row.country, datestr]],)
+    lines = [print_sample_info(row) for row in metadata.itertuples()]
+    #pick one from each child group. This ensures that the LCA of the named group is the correct root of the lineage.
+    selection = list(metadata.groupby("FromChild", group_keys=False).strain.sample(1, random_state=rng))
+    if len(selection) > count:
+        #more children than names to show; samples from any two of them still span the root.
+        selection = list(rng.choice(selection, size=count, replace=False))
+    remaining = metadata[~metadata.strain.isin(selection)]
+    selection.extend(remaining.strain.sample(min([count - len(selection), remaining.shape[0]]), replace=False, random_state=rng))
+    assert len(selection) <= count
+    return lines, selection
+
+def render_proposal(task):
+    """Render the sample list and issue text of one proposal; run in the worker pool.
+    """
+    row, metadata, scount, samplecount, prefix, tree, seed = task
+    lines, selected_samples = write_sample_list(metadata, samplecount, seed)
+    report, fortitle, common_country = write_report(row, prefix, selected_samples, scount, tree, row.proposed_sublineage_nid)
+    return lines, report, fortitle, common_country
+
+def read_sample_list(path):
+    """Return the sample names in the first column of a *_samples.txt file.
+    """
+    samples = []
+    with open(path) as inf:
+        for entry in inf:
+            fields = entry.rstrip("\n").split("\t")
+            if len(fields) != 3 or len(fields[0]) == 0:
+                print("WARNING: following did not parse correctly")
+                print(entry)
+                continue
+            samples.append(fields[0])
+    return samples
+
+class SampleCoverage:
+    """The samples named in the *_samples.txt files of earlier proposals, indexed in a SQLite database next to them.
+
+    The database records the size and modification time of each file it has read, so opening it only reads the
+    sample lists that are new or changed since the last run, and forgets those that were removed.
+    """
+    def __init__(self, path = ".proposed_samples.sqlite", pattern = "*_samples.txt"):
+        self.db = sqlite3.connect(path)
+        with self.db:
+            self.db.execute("CREATE TABLE IF NOT EXISTS files (name TEXT PRIMARY KEY, size INTEGER, mtime INTEGER)")
+            self.db.execute("CREATE TABLE IF NOT EXISTS samples (sample TEXT, file TEXT)")
+            self.db.execute("CREATE INDEX IF NOT EXISTS sample_index ON samples (sample)")
+            self.db.execute("CREATE INDEX IF NOT EXISTS file_index ON samples (file)")
+        known = {name:(size, mtime) for name, size, mtime in self.db.execute("SELECT name, size, mtime FROM files")}
+        current = glob.glob(pattern)
+        with self.db:
+            for name in known.keys() - set(current):
+                self.forget(name)
+        self.update([f for f in current if known.get(f) != self.stat(f)])
+
+    @staticmethod
+    def stat(path):
+        st = os.stat(path)
+        return st.st_size, st.st_mtime_ns
+
+    def forget(self, name):
+        self.db.execute("DELETE FROM samples WHERE file = ?", (name,))
+        self.db.execute("DELETE FROM files WHERE name = ?", (name,))
+
+    def update(self, files):
+        """Read the given sample list files into the index, replacing anything recorded for them before.
+        """
+        with self.db:
+            for name in files:
+                self.forget(name)
+                self.db.executemany("INSERT INTO samples VALUES (?, ?)", ((sample, name) for sample in read_sample_list(name)))
+                self.db.execute("INSERT INTO files VALUES (?, ?, ?)", (name,) + self.stat(name))
+
+    def __len__(self):
+        return self.db.execute("SELECT COUNT(DISTINCT sample) FROM samples").fetchone()[0]
+
+    def overlaps(self, samples):
+        """Whether any of samples is named in an indexed sample list, checked with a single query.
+        """
+        self.db.execute("CREATE TEMP TABLE IF NOT EXISTS query (sample TEXT)")
+        self.db.execute("DELETE FROM query")
+        self.db.executemany("INSERT INTO query VALUES (?)", ((sample,) for sample in samples))
+        return self.db.execute("SELECT EXISTS (SELECT 1 FROM query JOIN samples ON query.sample = samples.sample)").fetchone()[0] == 1
+
+def write_json(t, index, nid, parent_nid, name, prefix, size, metafile = None):
     outn = prefix + name + ".json"
-    samples_to_use = t.get_leaves_ids(nid)
-    parent_samples = t.get_leaves_ids(parent_nid)
+    samples_to_use = index.get_leaves_ids(index.ordinal(nid))
+    parent_samples = index.get_leaves_ids(index.ordinal(parent_nid))
     if len(samples_to_use) + len(parent_samples) > size:
         target = size - len(samples_to_use)
         parents_to_use = list(np.random.choice(parent_samples, size = target, replace = False))
@@ -179,51 +244,87 @@ def write_json(t, nid, parent_nid, name, prefix, size, metafile = None):
 
 def main():
     args = argparser()
-    t = bte.MATree(args.tree)
+    index = load_tree_index(args.tree)
     tn = ".".join(args.tree.split(".")[:-2])
     df = pd.read_csv(args.input,sep='\t')
-    mdf = pd.read_csv(args.metadata,sep='\t')
-    mdf['date'] = mdf.date.apply(get_date)
+    store = load_metadata_store(args.metadata)
+    mdf = store.frame(['strain','country','date'])
     mdf.sort_values('date',inplace=True)
+    #the metadata row of every leaf is looked up once, as its position in the date-sorted table.
+    rank = np.full(mdf.shape[0], -1, dtype=np.int64)
+    rank[mdf.index.values] = np.arange(mdf.shape[0])
+    leaf_rows = store.rows(index.get_leaves_ids())
+    leaf_rows = np.where(leaf_rows >= 0, rank[leaf_rows], -1)
+    coverage = None
     if args.skip:
-        samset = get_current_proposed_covered()
-    else:
-        samset = set()
-    if len(samset) == 0 and args.skip:
-        print("Found no current samples in *_samples.txt files.")
-    elif args.skip:
-        print("Found {} samples in *_samples.txt files; fresh proposals containing any of these samples will not be reported as new lineages.".format(len(samset)))
-    i = 0
+        coverage = SampleCoverage()
+        if len(coverage) == 0:
+            print("Found no current samples in *_samples.txt files.")
+        else:
+            print("Found {} samples in *_samples.txt files; fresh proposals containing any of these samples will not be reported as new lineages.".format(len(coverage)))
+    written = []
+    candidates = []
     for ind,d in df.sort_values(args.sort, ascending=False).iterrows():
-        if i >= args.number:
-            break
         if "(" in d.proposed_sublineage:
             print("Skipping {} for appearing not to be from a pangolin lineage...".format(d.proposed_sublineage))
             continue
-        print("Recording output for {}".format(d.proposed_sublineage))
-        print("Writing samples...")
-        selected_samples, scount = write_sample_list(t, mdf, d.proposed_sublineage_nid, d.proposed_sublineage, args.prefix, args.samplecount, samset)
-        if len(selected_samples) == 0:
-            print("{} has no metadata or includes samples already covered by open proposals; skipping.".format(d.proposed_sublineage))
-            continue
-        print("Writing report...")
-        report, fortitle, common_country = write_report(d, args.prefix, selected_samples, scount, args.tree, d.proposed_sublineage_nid)
-        titlestring = "{} {} samples".format(d.proposed_sublineage_size, d.parent)
-        if common_country != None:
-            titlestring += " in {}".format(common_country)
-        if len(fortitle) > 0:
-            titlestring += " with {}".format(fortitle)
-        if args.local:
-            with open(args.prefix + d.proposed_sublineage + ".md","w+") as outf:
-                print("Title: " + titlestring, file=outf)
-                print("\n".join(report), file=outf)
-        else:
-            g = Github(os.getenv("API_KEY"))
-            r = g.get_user().get_repo("auto-pango-designation")
-            r.create_issue(title=titlestring,body="\n".join(report))
-        # print("Writing json...")
-        # write_json(t, d.proposed_sublineage_nid, d.parent_nid, d.proposed_sublineage, args.prefix, args.jsonsize, args.metadata)
-        i += 1
+        candidates.append(d)
+    pool = ProcessPoolExecutor(max_workers=args.threads) if args.threads > 1 else None
+    i = 0
+    start = 0
+    #proposals are rendered a window at a time, just enough to fill the remaining count if none are skipped.
+    #files are written in ranked order afterwards, so nothing is written for proposals past the last one reported.
+    while i < args.number and start < len(candidates):
+        window = candidates[start:start + args.number - i]
+        start += len(window)
+        tasks = []
+        for d in window:
+            samples, metadata = proposal_samples(index, leaf_rows, mdf, d.proposed_sublineage_nid)
+            if coverage != None and coverage.overlaps(samples):
+                print("Proposal {} overlaps with existing proposals; skipping".format(d.proposed_sublineage))
+                tasks.append(None)
+            elif metadata.shape[0] == 0:
+                print("None of the samples of lineage {} have accompanying metadata; skipping".format(d.proposed_sublineage))
+                tasks.append(None)
+            else:
+                tasks.append((d, metadata, len(samples), args.samplecount, args.prefix, args.tree, np.random.randint(2**32)))
+        todo = [task for task in tasks if task != None]
+        rendered = iter(pool.map(render_proposal, todo) if pool != None else map(render_proposal, todo))
+        for d, task in zip(window, tasks):
+            print("Recording output for {}".format(d.proposed_sublineage))
+            print("Writing samples...")
+            written.append(args.prefix + d.proposed_sublineage + "_samples.txt")
+            with open(written[-1],"w+") as outf:
+                if task != None:
+                    lines, report, fortitle, common_country = next(rendered)
+                    for line in lines:
+                        print(line, file=outf)
+            if task == None:
+                print("{} has no metadata or includes samples already covered by open proposals; skipping.".format(d.proposed_sublineage))
+                continue
+            print("Writing report...")
+            titlestring = "{} {} samples".format(d.proposed_sublineage_size, d.parent)
+            if common_country != None:
+                titlestring += " in {}".format(common_country)
+            if len(fortitle) > 0:
+                titlestring += " with {}".format(fortitle)
+            if args.local:
+                with open(args.prefix + d.proposed_sublineage + ".md","w+") as outf:
+                    print("Title: " + titlestring, file=outf)
+                    print("\n".join(report), file=outf)
+            else:
+                g = Github(os.getenv("API_KEY"))
+                r = g.get_user().get_repo("auto-pango-designation")
+                r.create_issue(title=titlestring,body="\n".join(report))
+            # print("Writing json...")
+            # import bte
+            # write_json(bte.MATree(args.tree), index, d.proposed_sublineage_nid, d.parent_nid, d.proposed_sublineage, args.prefix, args.jsonsize, args.metadata)
+            i += 1
+    if pool != None:
+        pool.shutdown()
+    if coverage != None:
+        #lists written by this run are only checked against from the next one on, as before.
+        coverage.update([f for f in map(os.path.normpath, written) if os.path.dirname(f) == ""])
     with open(tn+".issues.log","w+") as outf:
         print("Produced files for {} lineage proposals.".format(args.number),file=outf)
 